@@ -0,0 +1,305 @@
+#! /usr/bin/env python
+"""
+Asynchronous serving mode: the /ask endpoint as an ASGI app (Starlette, served by uvicorn).
+
+python asgi_app.py --port 5000 --threads 8 --max-pending 64
+
+/ask takes and answers the same JSON as the Flask app in qa_web_app.py. Each turn runs in
+three steps:
+1. On the executor, the session is looked at to find the texts the turn will classify
+   (qa_web_app.turn_texts).
+2. On the event loop, they are all sent to Wit.ai at once with AsyncWitBackend. Waiting on
+   Wit.ai ties up no thread, so one process can hold thousands of open conversations.
+3. On the executor, the turn runs with those responses prefilled: the dialogue state machine,
+   encoding the question and searching the index.
+The executor is bounded (TurnExecutor): threads turns run at once and at most max_pending
+more wait for a thread. Past that, /ask answers 503 with BUSY_ANSWER and a Retry-After
+header, rather than letting the queue and everyone's latency grow.
+
+Every other endpoint (/ask_batch, /metrics, /healthz, /readyz) is the Flask app's, mounted
+as a WSGI app. Sessions are kept in memory, so this runs as a single process.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import PlainTextResponse
+from starlette.routing import Mount, Route
+
+import metrics
+import qa_web_app
+from intents import FallbackIntentBackend, empty_response, prefilled
+from qa_web_app import Agent, BackgroundLoader, get_answer, turn_texts
+
+BUSY_ANSWER = "I'm helping a lot of students right now. Please ask me again in a moment."
+# Wit.ai API version sent with every call, as the wit client does
+WIT_API_VERSION = os.environ.get("WIT_API_VERSION", "20200513")
+
+
+class Busy(Exception):
+    """Raised when the executor already has as many turns as it will take."""
+
+
+class TurnExecutor:
+    """
+    Thread pool for the synchronous parts of a turn, taking at most threads + max_pending
+    jobs at a time. Only used from the event loop thread, so the count needs no lock.
+    """
+
+    def __init__(self, threads: int = 8, max_pending: int = 64):
+        self.limit = threads + max_pending
+        self.in_flight = 0
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="turn")
+
+    async def run(self, func, *args):
+        """Runs func(*args) on the pool, raising Busy instead of queueing past the limit."""
+        if self.in_flight >= self.limit:
+            raise Busy()
+        self.in_flight += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self._executor, metrics.propagate(func), *args
+            )
+        finally:
+            self.in_flight -= 1
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+class AsyncWitBackend:
+    """
+    Calls Wit.ai's message API with httpx, so waiting on it doesn't hold a thread.
+    Goes to WIT_URL when it's set, like the wit client, e.g. for wit_stub.py.
+    """
+
+    def __init__(self, access_token: str, timeout: float = 5.0):
+        self.url = os.environ.get("WIT_URL", "https://api.wit.ai").rstrip("/")
+        self._client = httpx.AsyncClient(
+            timeout=timeout,
+            headers={"Authorization": f"Bearer {access_token}", "Accept": "application/json"},
+        )
+
+    async def message(self, text: str) -> Dict:
+        with metrics.timed("wit"):
+            try:
+                response = await self._client.get(
+                    self.url + "/message", params={"v": WIT_API_VERSION, "q": text}
+                )
+                response.raise_for_status()
+            except httpx.TimeoutException:
+                metrics.WIT_CALLS.inc(outcome="timeout")
+                raise
+            except Exception:
+                metrics.WIT_CALLS.inc(outcome="error")
+                raise
+        metrics.WIT_CALLS.inc(outcome="ok")
+        return response.json()
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+class TurnClassifier:
+    """
+    Classifies the texts of a turn with AsyncWitBackend. Responses go in the agents'
+    PrefilledIntentBackend, so texts are only sent to Wit.ai once. With the fallback intent
+    backend, texts Wit.ai doesn't answer within its latency budget get the local
+    classifier's answer for this turn, as FallbackIntentBackend would give them.
+    """
+
+    def __init__(self, nlu, loader, executor: TurnExecutor, wit: AsyncWitBackend, latency_budget=None):
+        self.nlu = nlu
+        self.loader = loader
+        self.executor = executor
+        self.wit = wit
+        self.latency_budget = latency_budget
+
+    def _fallback(self):
+        backend = self.nlu.backend
+        if isinstance(backend, BackgroundLoader):
+            backend = backend.loaded_nlu
+        return backend.fallback if isinstance(backend, FallbackIntentBackend) else None
+
+    async def _wit_message(self, text: str) -> Dict:
+        response = await self.wit.message(text)
+        self.nlu.put(text, response)
+        return response
+
+    async def _classify(self, text: str) -> Dict:
+        call = asyncio.ensure_future(self._wit_message(text))
+        try:
+            if self.latency_budget is None:
+                return await call
+            # Shielded, so a call that outlives the budget still fills the cache
+            return await asyncio.wait_for(asyncio.shield(call), self.latency_budget)
+        except asyncio.TimeoutError:
+            print(f"Wit.ai took longer than {self.latency_budget}s for {text!r}")
+        except Exception as e:
+            print(f"Wit.ai failed for {text!r}: {e!r}")
+        fallback = self._fallback()
+        if fallback is None:
+            # What Agent.classify answers when the backend fails
+            return empty_response(text)
+        return await self.executor.run(fallback.message, text)
+
+    async def _classify_all(self, texts: List[str]) -> Dict[str, Dict]:
+        missing = [text for text in dict.fromkeys(texts) if self.nlu.get(text) is None]
+        responses = await asyncio.gather(*(self._classify(text) for text in missing))
+        return dict(zip(missing, responses))
+
+    async def classify(self, texts: List[str], resolved: Optional[str] = None) -> Dict[str, Dict]:
+        """
+        Responses for the texts Wit.ai hadn't answered before, text -> response. resolved,
+        the first text with its anaphora resolved, is classified at the same time as the others
+        (unless the first text is a plain yes or no), and kept only if the first text's
+        classification needs it. Otherwise its call is cancelled.
+        """
+        if self.loader is not None and not self.loader.ready.is_set():
+            # The startup classifier answers without any I/O
+            return {}
+        resolving = None
+        if resolved is not None and not Agent.is_yes_no_reply(texts[0]):
+            resolving = asyncio.ensure_future(self._classify_all([resolved]))
+        responses = await self._classify_all(texts)
+        if resolved is not None:
+            first = responses.get(texts[0]) or self.nlu.get(texts[0])
+            if first is not None and Agent.may_need_resolution(first):
+                responses.update(await (resolving or self._classify_all([resolved])))
+            elif resolving is not None:
+                resolving.cancel()
+        return responses
+
+
+def peek_turn_texts(sessions, session_id: str, question: str) -> Tuple[List[str], Optional[str]]:
+    with sessions.session(session_id) as agent:
+        return turn_texts(question, agent)
+
+
+def run_turn(sessions, session_id: str, question: str, responses: Dict[str, Dict]):
+    """Answers question in the session, with responses classified ahead. Returns the answer and new state."""
+    with prefilled(responses):
+        with sessions.session(session_id) as agent:
+            answer = get_answer(question, agent)
+            return answer, agent.current_state
+
+
+def create_asgi_app(threads: int = 8, max_pending: int = 64, **kwargs) -> Starlette:
+    """
+    Builds the async app around qa_web_app.create_app(**kwargs). Wit.ai is called
+    asynchronously when it's the configured intent backend (ATAM_INTENT_BACKEND wit or
+    fallback) and no other nlu is passed in. Otherwise the intent backend runs on the executor.
+    """
+    use_wit = kwargs.get("nlu") is None and qa_web_app.INTENT_BACKEND in ("wit", "fallback")
+    flask_app = qa_web_app.create_app(prefill_intents=True, **kwargs)
+    atam = flask_app.extensions["atam"]
+    sessions, loader = atam["sessions"], atam["loader"]
+    executor = TurnExecutor(threads, max_pending)
+    classifier = None
+    metrics.REGISTRY.gauge(
+        "atam_turns_in_flight",
+        "Turns running or waiting on the async server's executor",
+        callback=lambda: executor.in_flight,
+    )
+
+    async def startup():
+        nonlocal classifier
+        if use_wit:
+            wit = AsyncWitBackend(qa_web_app.read_access_token(), qa_web_app.WIT_TIMEOUT)
+            budget = qa_web_app.WIT_LATENCY_BUDGET if qa_web_app.INTENT_BACKEND == "fallback" else None
+            classifier = TurnClassifier(atam["nlu"], loader, executor, wit, budget)
+
+    async def shutdown():
+        if classifier is not None:
+            await classifier.wit.close()
+        executor.shutdown()
+
+    async def answer(request):
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        question = data.get("question") if isinstance(data, dict) else None
+        if not question:
+            return PlainTextResponse("Error: Bad JSON. Needs question field.")
+        if loader is not None and not loader.can_answer(question):
+            return PlainTextResponse(
+                qa_web_app.NOT_READY_ANSWER, 503, headers={"Retry-After": "5"}
+            )
+        session_id = data.get("session_id") or uuid.uuid4().hex
+        try:
+            responses = {}
+            if classifier is not None:
+                texts, resolved = await executor.run(peek_turn_texts, sessions, session_id, question)
+                responses = await classifier.classify(texts, resolved)
+            answer, state = await executor.run(run_turn, sessions, session_id, question, responses)
+        except Busy:
+            return PlainTextResponse(BUSY_ANSWER, 503, headers={"Retry-After": "1"})
+        return PlainTextResponse(
+            answer, headers={"X-Session-Id": session_id, "X-Dialogue-State": state}
+        )
+
+    async def ask(request):
+        """/ask, timed and traced like the Flask app's requests."""
+        start = time.perf_counter()
+        trace = metrics.start_trace() if request.headers.get("X-ATAM-Trace") else None
+        response = await answer(request)
+        elapsed = time.perf_counter() - start
+        metrics.REQUEST_SECONDS.observe(elapsed, endpoint="atam.ask")
+        metrics.REQUESTS.inc(endpoint="atam.ask", status=response.status_code)
+        if trace is not None:
+            stages = [{"stage": stage, "ms": round(seconds * 1000, 3)} for stage, seconds in trace]
+            response.headers["X-ATAM-Trace"] = json.dumps(
+                {"total_ms": round(elapsed * 1000, 3), "stages": stages}
+            )
+            metrics.end_trace()
+        return response
+
+    app = Starlette(
+        routes=[Route("/ask", ask, methods=["POST"]), Mount("/", WSGIMiddleware(flask_app))],
+        on_startup=[startup],
+        on_shutdown=[shutdown],
+    )
+    return CORSMiddleware(
+        app,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Session-Id", "X-Dialogue-State", "X-ATAM-Trace"],
+    )
+
+
+def main():
+    import uvicorn
+
+    parser = ArgumentParser()
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=8, help="Threads running turns")
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=64,
+        help="Turns that may wait for a thread before /ask answers busy",
+    )
+    parser.add_argument("--quiet", action="store_true", help="Turn off debug mode")
+    parser.add_argument(
+        "--lazy",
+        action="store_true",
+        help="Start serving at once and load the model and index in the background",
+    )
+    args = parser.parse_args()
+    app = create_asgi_app(args.threads, args.max_pending, debug=not args.quiet, lazy=args.lazy)
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
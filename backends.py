@@ -0,0 +1,120 @@
+"""
+Search backends for SimilaritySearch. A backend is an index with the part of AnnoyIndex's
+interface that SimilaritySearch uses: add_item, build, save, load and get_nns_by_vector.
+
+- annoy: Annoy's approximate index, tuned with trees and search_k (see tune_index.py).
+- exact: ExactIndex, brute force search with NumPy. Exact results, and for a corpus the size
+  of one textbook often as fast as Annoy. get_nns_by_vectors answers a batch of queries with
+  a single matrix product.
+
+Index files are replaced rather than rewritten in place (see replace_file), like Annoy does
+when it saves, so processes still serving a loaded index aren't affected by a rebuild.
+"""
+import os
+from typing import Callable, List, Tuple
+
+import numpy as np
+from annoy import AnnoyIndex
+
+# backend -> name of its index file in the index directory
+INDEX_FILES = {"annoy": "index.ann", "exact": "index.npz"}
+
+
+def replace_file(filename: str, write: Callable) -> None:
+    """
+    Calls write with a binary file opened next to filename, then moves that file over filename.
+    Processes that memory mapped the old file keep reading it, where truncating it under them
+    would kill them with SIGBUS.
+    """
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class ExactIndex:
+    """
+    Keeps every vector in one float32 matrix. Distances match Annoy's for the same metric:
+    euclidean, or angular (euclidean distance between the normalized vectors).
+    """
+
+    def __init__(self, f: int, metric: str = "euclidean"):
+        if metric not in ("euclidean", "angular"):
+            raise ValueError(f"Unsupported metric {metric!r}")
+        self.f = f
+        self.metric = metric
+        self._items = {}
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._vectors = np.zeros((0, f), dtype=np.float32)
+        self._squared_norms = np.zeros(0, dtype=np.float32)
+
+    def add_item(self, i: int, vector) -> None:
+        self._items[i] = np.asarray(vector, dtype=np.float32)
+
+    def build(self, trees: int = -1) -> None:
+        """Stacks the added vectors into the search matrix. trees is ignored."""
+        ids = sorted(self._items)
+        vectors = (
+            np.stack([self._items[i] for i in ids])
+            if ids
+            else np.zeros((0, self.f), dtype=np.float32)
+        )
+        self._set(np.asarray(ids, dtype=np.int64), vectors)
+        self._items = {}
+
+    def _set(self, ids, vectors) -> None:
+        if self.metric == "angular":
+            vectors = self._normalize(vectors)
+        self._ids = ids
+        self._vectors = vectors
+        self._squared_norms = np.einsum("ij,ij->i", vectors, vectors)
+
+    @staticmethod
+    def _normalize(vectors):
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+    def get_n_items(self) -> int:
+        return len(self._ids)
+
+    def save(self, filename: str) -> None:
+        replace_file(filename, lambda f: np.savez(f, ids=self._ids, vectors=self._vectors))
+
+    def load(self, filename: str) -> None:
+        with np.load(filename) as arrays:
+            self._set(arrays["ids"], arrays["vectors"])
+
+    def get_nns_by_vector(self, vector, n: int, search_k: int = -1, include_distances: bool = False):
+        indices, distances = self.get_nns_by_vectors([vector], n)[0]
+        return (indices, distances) if include_distances else indices
+
+    def get_nns_by_vectors(self, vectors, n: int) -> List[Tuple[List[int], List[float]]]:
+        """The ids and distances of the n nearest items to each of the vectors."""
+        queries = np.asarray(vectors, dtype=np.float32).reshape(-1, self.f)
+        if self.metric == "angular":
+            queries = self._normalize(queries)
+        n = min(n, len(self._ids))
+        if n == 0:
+            return [([], []) for _ in queries]
+        # |x - q|^2 = |x|^2 - 2 x.q + |q|^2, with the x.q for every pair from one matmul
+        squared = self._squared_norms[None, :] - 2 * (queries @ self._vectors.T)
+        squared += np.einsum("ij,ij->i", queries, queries)[:, None]
+        nearest = np.argpartition(squared, n - 1, axis=1)[:, :n]
+        results = []
+        for row, candidates in zip(squared, nearest):
+            candidates = candidates[np.argsort(row[candidates])]
+            distances = np.sqrt(np.maximum(row[candidates], 0))
+            results.append((self._ids[candidates].tolist(), distances.tolist()))
+        return results
+
+
+def new_index(backend: str, f: int, metric: str = "euclidean"):
+    """An empty index of the given backend for f dimensional vectors."""
+    if backend == "annoy":
+        return AnnoyIndex(f, metric)
+    if backend == "exact":
+        return ExactIndex(f, metric)
+    raise ValueError(f"Unknown search backend {backend!r}, expected one of {list(INDEX_FILES)}")
@@ -0,0 +1,342 @@
+#! /usr/bin/env python
+"""
+Benchmarks for index building, retrieval and the /ask endpoint.
+
+python benchmark.py data/cleaned_jurafsky_and_martin.txt --output bench.json
+
+Times sentence splitting and index building in sentences/sec, measures p50/p95/p99 latency
+of query and query_top_chunks over the questions in data/benchmark_questions.txt, and
+measures /ask throughput with Wit.ai replaced by the local stub in wit_stub.py.
+The compression part compares recall@10 and search latency of normalized, PCA reduced and
+quantized indexes against the uncompressed one. The batching part sends cold queries from
+--concurrency threads at once, with and without micro-batching (QueryBatcher) at each window.
+Results are written as JSON so runs can be compared when changing trees, models or
+serving setup.
+"""
+import json
+import os
+import platform
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import numpy as np
+
+import encoders
+from compression import CODES_FILE, SCALES_FILE
+from questionanswer import EmbeddingCache, Preprocessor, QueryBatcher, SimilaritySearch
+
+PARTS = ("preprocess", "build", "query", "batching", "ask", "compression")
+QUESTIONS_PATH = "data/benchmark_questions.txt"
+
+
+def load_questions(path: str = QUESTIONS_PATH) -> List[str]:
+    with open(path, "r", encoding="utf8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def latency_summary(latencies: List[float]) -> Dict:
+    """Summarizes latencies given in seconds, in milliseconds."""
+    ms = np.asarray(latencies) * 1000
+    return {
+        "count": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+
+
+def time_calls(func: Callable[[str], object], inputs: List[str], before=None) -> List[float]:
+    """Times func on each input, calling before() (untimed) ahead of every call."""
+    latencies = []
+    for text in inputs:
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        func(text)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_preprocess(text: str, processes: int):
+    start = time.perf_counter()
+    sentences = Preprocessor(processes).preprocess_text(text)
+    elapsed = time.perf_counter() - start
+    result = {
+        "sentences": len(sentences),
+        "seconds": elapsed,
+        "sentences_per_sec": len(sentences) / elapsed,
+    }
+    return result, sentences
+
+
+def bench_build(
+    model, embedding_size: int, sentences: List[str], trees: int, batch_size: int, processes: int
+):
+    search = SimilaritySearch(model, embedding_size)
+    start = time.perf_counter()
+    search.build_annoy_index(sentences, trees, batch_size, processes)
+    elapsed = time.perf_counter() - start
+    result = {
+        "sentences": len(sentences),
+        "trees": trees,
+        "batch_size": batch_size,
+        "processes": processes,
+        "seconds": elapsed,
+        "sentences_per_sec": len(sentences) / elapsed,
+    }
+    return result, search
+
+
+def bench_query(search, questions: List[str], repeat: int) -> Dict:
+    """
+    Latency of query and query_top_chunks. "cold" clears the caches before every call,
+    "cached" repeats the questions with the caches warm.
+    """
+    inputs = questions * repeat
+
+    def clear():
+        search.encoder.cache.clear()
+        search.clear_cache()
+
+    results = {}
+    calls = {
+        "query": lambda q: search.query(q, n=10),
+        "query_top_chunks": lambda q: search.query_top_chunks(q, window_size=3, chunks=3),
+    }
+    for name, func in calls.items():
+        results[name] = {
+            "cold": latency_summary(time_calls(func, inputs, clear)),
+            "cached": latency_summary(time_calls(func, inputs)),
+        }
+    return results
+
+
+def bench_batching(
+    search, questions: List[str], concurrency: int, windows: List[float], max_batch: int
+) -> Dict:
+    """
+    Throughput and latency of query with concurrency threads asking at once and the caches
+    cold, first without micro-batching, then with a QueryBatcher for each window.
+    """
+
+    def run(batcher):
+        search.batcher = batcher
+        search.encoder.cache.clear()
+        search.clear_cache()
+
+        def call(question):
+            start = time.perf_counter()
+            search.query(question, n=10)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(call, questions))
+        elapsed = time.perf_counter() - start
+        return {
+            "requests_per_sec": len(questions) / elapsed,
+            "latency": latency_summary(latencies),
+        }
+
+    results = {"concurrency": concurrency, "max_batch": max_batch, "unbatched": run(None)}
+    for window in windows:
+        results[f"window_{window}"] = run(QueryBatcher(search, window, max_batch))
+    search.batcher = None
+    return results
+
+
+def bench_compression(
+    model,
+    embedding_size: int,
+    sentences: List[str],
+    questions: List[str],
+    trees: int,
+    batch_size: int,
+    pca_dim: int,
+) -> Dict:
+    """
+    Builds the index with each compression setting and compares it to the uncompressed one.
+    recall_at_10 is the share of the uncompressed index's 10 nearest sentences per question
+    that the compressed index also returns. Latency is of the search alone, without encoding.
+    """
+    settings = {
+        "uncompressed": None,
+        "normalized": {"normalize": True},
+        f"pca{pca_dim}": {"normalize": True, "pca_dim": pca_dim},
+        f"pca{pca_dim}_float16": {"normalize": True, "pca_dim": pca_dim, "quantize": "float16"},
+        f"pca{pca_dim}_int8": {"normalize": True, "pca_dim": pca_dim, "quantize": "int8"},
+    }
+    results = {}
+    reference = None
+    with tempfile.TemporaryDirectory() as tmp:
+        # Sentences are encoded once, for the first build
+        embedding_cache = EmbeddingCache(tmp, "benchmark")
+        embeddings = None
+        for name, compression in settings.items():
+            search = SimilaritySearch(model, embedding_size, compression=compression)
+            search.build_annoy_index(sentences, trees, batch_size, embedding_cache=embedding_cache)
+            path = os.path.join(tmp, name)
+            os.makedirs(path)
+            search.save(path)
+            if embeddings is None:
+                embeddings = [search.encode_query(question) for question in questions]
+            latencies = []
+            neighbours = []
+            for embedding in embeddings:
+                start = time.perf_counter()
+                found = search.nearest(embedding, 10)
+                latencies.append(time.perf_counter() - start)
+                neighbours.append({result.index for result in found})
+            if reference is None:
+                reference = neighbours
+            recall = [len(ref & found) / len(ref) for ref, found in zip(reference, neighbours)]
+            compression_files = ["compression.npz", CODES_FILE, SCALES_FILE]
+            compression_paths = [os.path.join(path, name) for name in compression_files]
+            results[name] = {
+                "compression": compression,
+                "recall_at_10": float(np.mean(recall)),
+                "latency": latency_summary(latencies),
+                "index_bytes": os.path.getsize(os.path.join(path, "index.ann")),
+                "compression_bytes": sum(
+                    os.path.getsize(file) for file in compression_paths if os.path.exists(file)
+                ),
+            }
+    return results
+
+
+def bench_ask(questions: List[str], concurrency: int, wit_latency: float) -> Dict:
+    """
+    Throughput of /ask. Each question is one simulated student asking it and answering
+    "yes", with concurrency students at a time. Wit.ai is replaced by StubWitBackend.
+    """
+    import qa_web_app
+    from wit_stub import StubWitBackend
+
+    app = qa_web_app.create_app(nlu=StubWitBackend(wit_latency), debug=False)
+
+    def converse(args):
+        session, question = args
+        client = app.test_client()
+        latencies = []
+        for text in (question, "yes"):
+            start = time.perf_counter()
+            response = client.post("/ask", json={"question": text, "session_id": session})
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.status_code
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        conversations = list(executor.map(converse, enumerate(questions)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for conversation in conversations for latency in conversation]
+    return {
+        "concurrency": concurrency,
+        "wit_latency_s": wit_latency,
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "requests_per_sec": len(latencies) / elapsed,
+        "latency": latency_summary(latencies),
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("text", help="Reference text to preprocess and index")
+    parser.add_argument(
+        "--parts", nargs="+", choices=PARTS, default=list(PARTS), help="Benchmarks to run"
+    )
+    parser.add_argument("--questions", default=QUESTIONS_PATH, help="One question per line")
+    parser.add_argument("--output", help="File to write the JSON results to")
+    parser.add_argument("--trees", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Times to go through the questions for query latency"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Simultaneous /ask students or batching threads"
+    )
+    parser.add_argument(
+        "--wit-latency", type=float, default=0.0, help="Seconds the Wit.ai stub waits per call"
+    )
+    parser.add_argument(
+        "--batch-windows",
+        nargs="+",
+        type=float,
+        default=[0.0, 0.002, 0.005],
+        help="Micro-batching windows in seconds for the batching benchmark",
+    )
+    parser.add_argument("--max-batch", type=int, default=32, help="Largest micro-batch")
+    parser.add_argument(
+        "--pca-dim", type=int, default=256, help="PCA dimensions for the compression benchmark"
+    )
+    parser.add_argument(
+        "--encoder",
+        choices=list(encoders.ENCODERS),
+        default=encoders.DEFAULT_ENCODER,
+        help="Sentence encoder to benchmark, see encoders.py",
+    )
+    parser.add_argument(
+        "--quantize-encoder", action="store_true", help="Quantize the encoder to int8"
+    )
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    results = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "encoder": encoders.describe(args.encoder, args.quantize_encoder),
+        "text": args.text,
+        "questions": len(questions),
+    }
+
+    sentences = None
+    if set(args.parts) & {"preprocess", "build", "query", "batching", "compression"}:
+        results["preprocess"], sentences = bench_preprocess(args.text, args.processes)
+
+    if set(args.parts) & {"build", "query", "batching", "compression"}:
+        start = time.perf_counter()
+        model = encoders.load_encoder(args.encoder, args.quantize_encoder)
+        results["model_load_seconds"] = time.perf_counter() - start
+    embedding_size = encoders.get_encoder(args.encoder).dimension
+    if set(args.parts) & {"build", "query", "batching"}:
+        results["build"], search = bench_build(
+            model, embedding_size, sentences, args.trees, args.batch_size, args.processes
+        )
+        if "query" in args.parts:
+            results["query"] = bench_query(search, questions, args.repeat)
+        if "batching" in args.parts:
+            results["batching"] = bench_batching(
+                search, questions, args.concurrency, args.batch_windows, args.max_batch
+            )
+
+    if "compression" in args.parts:
+        results["compression"] = bench_compression(
+            model,
+            embedding_size,
+            sentences,
+            questions,
+            args.trees,
+            args.batch_size,
+            args.pca_dim,
+        )
+
+    if "ask" in args.parts:
+        results["ask"] = bench_ask(questions, args.concurrency, args.wit_latency)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
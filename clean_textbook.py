@@ -1,27 +1,153 @@
 """
 Script to clean textbook data.
 Remove certain troublesome lines.
+
+python clean_textbook.py raw_textbook.txt cleaned_textbook.txt
+python clean_textbook.py data/raw_course_material/ -o data/cleaned_course_material.txt --processes 4
+
+Sources can be files or directories of .txt files. Large files are cut into chunks that are
+cleaned in parallel across a process pool. Cleaning can also run as part of index building
+(load_or_build_index(clean=True)), streaming cleaned lines straight into sentence splitting.
 """
+import io
+import json
+import os
 import re
-import sys
+from argparse import ArgumentParser
+from collections import Counter
+from multiprocessing import Pool
+from typing import Dict, Iterator, List, Tuple
+
+YEAR_CITATION_REGEX = re.compile(r"\(\d\d\d\d\)")
+HAS_LETTERS = re.compile(r"[A-Za-z]")
+
+# (name, test) for each reason to drop a line, in the order they're checked.
+# A dropped line is counted against the first rule it fails.
+RULES = (
+    ("year_citation", lambda line: YEAR_CITATION_REGEX.search(line) is not None),
+    ("no_letters", lambda line: HAS_LETTERS.search(line) is None),
+    ("single_word", lambda line: len(line.split()) <= 1),
+)
+
+
+def expand_sources(sources: List[str]) -> List[str]:
+    """Replaces directories in sources with the .txt files in them, in name order."""
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths.extend(
+                os.path.join(source, name)
+                for name in sorted(os.listdir(source))
+                if name.endswith(".txt")
+            )
+        else:
+            paths.append(source)
+    return paths
+
+
+def clean_lines(lines) -> Tuple[List[str], Counter]:
+    """The lines to keep, and how many lines each rule dropped."""
+    kept = []
+    drops = Counter()
+    for line in lines:
+        for name, test in RULES:
+            if test(line):
+                drops[name] += 1
+                break
+        else:
+            kept.append(line)
+    return kept, drops
+
+
+def file_chunks(path: str, chunk_bytes: int) -> List[Tuple[str, int, int]]:
+    """Splits the file into (path, start, end) byte ranges of about chunk_bytes, ending on line ends."""
+    size = os.path.getsize(path)
+    chunks = []
+    with open(path, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            chunks.append((path, start, end))
+            start = end
+    return chunks
+
+
+def clean_chunk(chunk: Tuple[str, int, int]) -> Tuple[List[str], Dict[str, int], int]:
+    """Cleans one file chunk. Returns the kept lines, drops per rule and the number of lines read."""
+    path, start, end = chunk
+    with open(path, "rb") as f:
+        f.seek(start)
+        # Split like reading the file in text mode would: on newlines only, with \r\n translated
+        lines = io.StringIO(f.read(end - start).decode("utf8"), newline=None).readlines()
+    kept, drops = clean_lines(lines)
+    return kept, dict(drops), len(lines)
+
+
+class Cleaner:
+    """
+    Cleans sources chunk_bytes at a time. With processes > 1, chunks are cleaned in a pool of
+    worker processes, while lines are still yielded in their original order.
+    Counts of lines read, kept and dropped by each rule add up across calls.
+    """
+
+    def __init__(self, processes: int = 1, chunk_bytes: int = 1 << 20):
+        self.processes = processes
+        self.chunk_bytes = chunk_bytes
+        self.lines = 0
+        self.kept = 0
+        self.drops = Counter()
+
+    def iter_clean(self, sources: List[str]) -> Iterator[str]:
+        """Yields the kept lines of every source, chunk by chunk as they're cleaned."""
+        chunks = [
+            chunk
+            for path in expand_sources(sources)
+            for chunk in file_chunks(path, self.chunk_bytes)
+        ]
+        if self.processes > 1:
+            with Pool(self.processes) as pool:
+                yield from self._collect(pool.imap(clean_chunk, chunks))
+        else:
+            yield from self._collect(map(clean_chunk, chunks))
+
+    def _collect(self, results) -> Iterator[str]:
+        for kept, drops, lines in results:
+            self.lines += lines
+            self.kept += len(kept)
+            self.drops.update(drops)
+            yield from kept
+
+    def stats(self) -> Dict:
+        return {"lines": self.lines, "kept": self.kept, "dropped": dict(self.drops)}
+
+    def clean_files(self, sources: List[str], output: str) -> None:
+        with open(output, "w", encoding="utf8") as outfile:
+            for line in self.iter_clean(sources):
+                outfile.write(line)
 
 
 def main():
-    YEAR_CITATION_REGEX = re.compile(r"\(\d\d\d\d\)")
-    HAS_LETTERS = re.compile(r"[A-Za-z]+")
-    text_path_in = sys.argv[1]
-    text_path_out = sys.argv[2]
-    with open(text_path_in, "r", encoding="utf8") as infile, open(
-        text_path_out, "w", encoding="utf8"
-    ) as outfile:
-        for line in infile:
-            if (
-                YEAR_CITATION_REGEX.findall(line)
-                or not HAS_LETTERS.findall(line)
-                or len(line.split()) <= 1
-            ):
-                continue
-            outfile.write(line)
+    parser = ArgumentParser()
+    parser.add_argument("sources", nargs="+", help="Text files or directories of .txt files")
+    parser.add_argument(
+        "-o", "--output", help="Cleaned text file. Defaults to the last positional argument"
+    )
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes to clean with")
+    parser.add_argument(
+        "--chunk-bytes", type=int, default=1 << 20, help="Size of the pieces files are cleaned in"
+    )
+    args = parser.parse_args()
+    sources, output = args.sources, args.output
+    if output is None:
+        if len(sources) < 2:
+            parser.error("Give an output file, with -o or as the last argument")
+        sources, output = sources[:-1], sources[-1]
+
+    cleaner = Cleaner(args.processes, args.chunk_bytes)
+    cleaner.clean_files(sources, output)
+    print(json.dumps(cleaner.stats(), indent=2))
 
 
 if __name__ == "__main__":
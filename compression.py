@@ -0,0 +1,141 @@
+"""
+Optional compression of sentence embeddings for SimilaritySearch.
+
+Three stages, each optional:
+- normalize: L2 normalize embeddings and index them with Annoy's angular metric.
+- pca_dim: project embeddings onto their top principal components (e.g. 768 -> 256),
+  fitted when the index is built and saved next to it. Shrinks the .ann file and speeds up search.
+- quantize: keep a float16 or int8 copy of the full embeddings. ANN candidates are then
+  re-scored against it, which wins back most of the recall lost to the projection.
+  The copy is saved in its own .npy files and memory mapped when loaded, so processes
+  serving the same index share it and only the rows of re-scored candidates are read.
+"""
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from backends import replace_file
+
+QUANTIZE_TYPES = (None, "float16", "int8")
+# Files holding the quantized embeddings and their int8 scales, next to compression.npz
+CODES_FILE = "compression.codes.npy"
+SCALES_FILE = "compression.scales.npy"
+
+
+class EmbeddingCompressor:
+    def __init__(
+        self,
+        normalize: bool = False,
+        pca_dim: Optional[int] = None,
+        quantize: Optional[str] = None,
+        rescore_factor: int = 4,
+    ):
+        """
+        With quantize set, rescore_factor times as many candidates as asked for are fetched
+        from the index and re-scored.
+        """
+        if quantize not in QUANTIZE_TYPES:
+            raise ValueError(f"quantize must be one of {QUANTIZE_TYPES}, not {quantize!r}")
+        self.normalize = normalize
+        self.pca_dim = pca_dim
+        self.quantize = quantize
+        self.rescore_factor = rescore_factor
+        self._mean = None
+        self._components = None
+        # Quantized embeddings by sentence id, and their per-row scales for int8
+        self._codes = None
+        self._scales = None
+
+    def config(self) -> Dict:
+        """The settings, as recorded in the index manifest."""
+        return {"normalize": self.normalize, "pca_dim": self.pca_dim, "quantize": self.quantize}
+
+    @property
+    def comparable(self) -> bool:
+        """
+        Whether search distances can be compared with those of another index built with the same
+        settings. Not with PCA alone, since each index fits its own projection. Re-scored
+        distances are in the full embedding space.
+        """
+        return not self.pca_dim or bool(self.quantize)
+
+    @property
+    def metric(self) -> str:
+        return "angular" if self.normalize else "euclidean"
+
+    def index_size(self, embedding_size: int) -> int:
+        """Number of dimensions of the vectors that go in the index."""
+        return self.pca_dim or embedding_size
+
+    def prepare(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.normalize:
+            norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+        return vectors
+
+    def project(self, vectors):
+        """Prepared vectors -> vectors for the index."""
+        if self._components is None:
+            return vectors
+        return (vectors - self._mean) @ self._components.T
+
+    def fit(self, ids: List[int], vectors, n_sentences: int) -> None:
+        """
+        Fits the PCA projection to the prepared vectors of the indexed sentences and keeps
+        their quantized copy. ids are the sentence ids of the vectors.
+        """
+        if self.pca_dim:
+            self._mean = vectors.mean(axis=0)
+            # Rows of vt are the principal directions, strongest first
+            _, _, vt = np.linalg.svd(vectors - self._mean, full_matrices=False)
+            self._components = vt[: self.pca_dim].astype(np.float32)
+        if self.quantize:
+            full = np.zeros((n_sentences, vectors.shape[1]), dtype=np.float32)
+            full[ids] = vectors
+            if self.quantize == "float16":
+                self._codes = full.astype(np.float16)
+            else:
+                self._scales = np.maximum(np.abs(full).max(axis=1), 1e-12) / 127
+                self._codes = np.round(full / self._scales[:, None]).astype(np.int8)
+                self._scales = self._scales.astype(np.float32)
+
+    def rescore(
+        self, query, indices: List[int], n: int
+    ) -> Tuple[List[int], List[float]]:
+        """
+        Re-ranks candidate sentence ids by euclidean distance between the prepared query
+        and their quantized embeddings, keeping the n closest.
+        """
+        vectors = self._codes[indices].astype(np.float32)
+        if self._scales is not None:
+            vectors *= self._scales[indices, None]
+        distances = np.linalg.norm(vectors - query, axis=1)
+        order = np.argsort(distances)[:n]
+        return [indices[i] for i in order], [float(distances[i]) for i in order]
+
+    def candidates(self, n: int) -> int:
+        """How many neighbours to fetch from the index to end up with n results."""
+        return n * self.rescore_factor if self.quantize else n
+
+    def save(self, path: str) -> None:
+        arrays = {}
+        if self._components is not None:
+            arrays.update(mean=self._mean, components=self._components)
+        replace_file(os.path.join(path, "compression.npz"), lambda f: np.savez(f, **arrays))
+        # Loaded compressors memory map these, so they must be replaced, not overwritten
+        if self._codes is not None:
+            replace_file(os.path.join(path, CODES_FILE), lambda f: np.save(f, self._codes))
+        if self._scales is not None:
+            replace_file(os.path.join(path, SCALES_FILE), lambda f: np.save(f, self._scales))
+
+    def load(self, path: str) -> None:
+        with np.load(os.path.join(path, "compression.npz")) as arrays:
+            self._mean = arrays["mean"] if "mean" in arrays else None
+            self._components = arrays["components"] if "components" in arrays else None
+        self._codes = self._scales = None
+        if self.quantize:
+            self._codes = np.load(os.path.join(path, CODES_FILE), mmap_mode="r")
+        if self.quantize == "int8":
+            self._scales = np.load(os.path.join(path, SCALES_FILE), mmap_mode="r")
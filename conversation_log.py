@@ -0,0 +1,137 @@
+"""
+Append-only JSON lines log of conversations, written off the request path.
+
+Records are queued in memory and a background thread appends them to the log in batches.
+The queue is bounded: when it's full, records are dropped and counted in
+atam_conversation_log_records_total{outcome="dropped"} rather than making a request wait.
+The log is rotated once it passes max_bytes, keeping backups old logs as path.1, path.2, ...
+"""
+import json
+import os
+import queue
+import threading
+from typing import Dict
+
+import metrics
+
+# Tells the writer thread to finish
+_STOP = object()
+
+
+class ConversationLog:
+    def __init__(
+        self,
+        path: str = "logs/conversations.jsonl",
+        max_queue: int = 10000,
+        batch_size: int = 256,
+        flush_interval: float = 1.0,
+        max_bytes: int = 10 * 1024 * 1024,
+        backups: int = 5,
+    ):
+        """
+        Queued records are written at least every flush_interval seconds, or as soon as
+        batch_size of them are waiting.
+        """
+        self.path = path
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def _start(self) -> None:
+        """
+        Starts the writer thread. Threads don't survive a fork, so a pre-forked worker
+        starts its own the first time it writes.
+        """
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.max_queue)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="conversation-log", daemon=True
+            )
+            self._thread.start()
+
+    def write(self, record: Dict) -> bool:
+        """Queues record to be logged. Returns False if the queue was full and it was dropped."""
+        if self._thread is None or self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            metrics.CONVERSATION_LOG_RECORDS.inc(outcome="dropped")
+            return False
+        return True
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Writes out whatever is queued and stops the writer thread."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                record = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            while record is not _STOP:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            stopping = record is _STOP
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    print(f"Couldn't write {len(batch)} conversation log records: {e!r}")
+                    metrics.CONVERSATION_LOG_RECORDS.inc(len(batch), outcome="error")
+
+    def _write_batch(self, batch) -> None:
+        """
+        Appends the batch in one write. A lock file keeps the workers of a multi-process
+        server from rotating the log under each other. Needs fcntl, so Unix only.
+        """
+        import fcntl
+
+        lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    self._rotate()
+                with open(self.path, "a", encoding="utf8") as f:
+                    f.write(lines)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        metrics.CONVERSATION_LOG_RECORDS.inc(len(batch), outcome="written")
+
+    def _rotate(self) -> None:
+        """path -> path.1 -> path.2 ..., dropping the oldest beyond backups."""
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
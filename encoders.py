@@ -0,0 +1,89 @@
+"""
+Sentence encoders the index and queries can be embedded with.
+
+Each encoder has a name in ENCODERS, with the sentence-transformers model behind it and the
+size of its embeddings. An index records which encoder built it in its manifest (see describe),
+so switching encoders rebuilds the index instead of mixing embeddings from two models.
+
+The smaller encoders trade some accuracy for much cheaper queries on CPU. Any of them can also
+be quantized: their Linear layers are converted to int8 with PyTorch dynamic quantization,
+which speeds up CPU inference again at a small cost in accuracy. Quantized encoders get
+their own embedding cache. eval_encoders.py compares encoders on the textbook questions.
+"""
+from typing import Dict, NamedTuple, Optional
+
+from sentence_transformers import SentenceTransformer
+
+
+class EncoderSpec(NamedTuple):
+    # sentence-transformers model name
+    model: str
+    # Size of the embeddings it makes
+    dimension: int
+    description: str = ""
+
+
+ENCODERS: Dict[str, EncoderSpec] = {
+    "bert-base": EncoderSpec("bert-base-nli-mean-tokens", 768, "BERT base, 12 layers"),
+    "distilbert": EncoderSpec(
+        "distilbert-base-nli-stsb-mean-tokens", 768, "DistilBERT, 6 layers, about twice as fast"
+    ),
+    "distilroberta": EncoderSpec(
+        "paraphrase-distilroberta-base-v1", 768, "DistilRoBERTa trained on paraphrases, 6 layers"
+    ),
+    # Needs a sentence-transformers release that knows the MiniLM models
+    "minilm": EncoderSpec(
+        "paraphrase-MiniLM-L6-v2", 384, "MiniLM, 6 layers of 384, several times faster"
+    ),
+    "glove": EncoderSpec(
+        "average_word_embeddings_glove.6B.300d", 300, "Averaged GloVe word vectors, no transformer"
+    ),
+}
+DEFAULT_ENCODER = "bert-base"
+
+
+def register_encoder(name: str, model: str, dimension: int, description: str = "") -> None:
+    """Adds an encoder, e.g. a fine-tuned model saved to disk, under name."""
+    ENCODERS[name] = EncoderSpec(model, dimension, description)
+
+
+def get_encoder(name: str) -> EncoderSpec:
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown encoder {name!r}, expected one of {list(ENCODERS)}")
+    return ENCODERS[name]
+
+
+def cache_name(name: str, quantize: bool = False) -> str:
+    """Name of the embedding cache for the encoder. Quantized embeddings are cached apart."""
+    model = get_encoder(name).model
+    return f"{model}-int8" if quantize else model
+
+
+def describe(name: str, quantize: bool = False) -> Dict:
+    """The encoder as recorded in an index manifest."""
+    spec = get_encoder(name)
+    return {"name": name, "model": spec.model, "dimension": spec.dimension, "quantized": quantize}
+
+
+def quantize_model(model):
+    """A copy of model with its Linear layers quantized to int8 for CPU inference."""
+    import torch
+
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_encoder(name: str, quantize: bool = False, path: Optional[str] = None):
+    """
+    Loads the encoder's model, from path if given (e.g. a saved copy of it), and checks it
+    makes embeddings of the size the registry says.
+    """
+    spec = get_encoder(name)
+    model = SentenceTransformer(path or spec.model)
+    dimension = model.get_sentence_embedding_dimension()
+    if dimension is not None and dimension != spec.dimension:
+        raise ValueError(
+            f"Encoder {name!r} makes {dimension} dimensional embeddings, not {spec.dimension}"
+        )
+    if quantize:
+        model = quantize_model(model)
+    return model
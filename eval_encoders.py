@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+"""
+Compares sentence encoders on a built index's sentences and the textbook questions.
+
+python eval_encoders.py data/shards/jurafsky_and_martin --encoders distilbert minilm glove --quantize
+
+For the reference encoder (the one the index was built with, unless --reference says otherwise)
+and each candidate, builds an index over the same sentences and reports:
+- load time, sentences encoded per second (encoding alone, not building the index) and
+  per question encode latency
+- the size of the index file, built with the index's backend and tree count
+- agreement with the reference: the share of the reference's k nearest sentences per question
+  that the candidate also returns, and how often both agree on the nearest one.
+The reference is measured quantized if the index was built with a quantized encoder.
+With --quantize, the int8 quantized version of every encoder is measured too.
+Candidates that fail to load (e.g. models the installed sentence-transformers doesn't know)
+are listed with the error instead of stopping the run.
+Searches use embeddings only, skipping the keyword index, so only the encoders are compared.
+"""
+import json
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import encoders
+from benchmark import QUESTIONS_PATH, latency_summary, load_questions, time_calls
+from questionanswer import EmbeddingCache, SentenceStore, SimilaritySearch
+
+
+def evaluate(
+    name: str,
+    quantize: bool,
+    sentences: List[str],
+    questions: List[str],
+    k: int,
+    backend: str,
+    trees: int,
+    batch_size: int,
+) -> Tuple[Dict, List[List[int]]]:
+    """
+    Measures one encoder. Returns its report and the ids of each question's k nearest sentences,
+    or a report with the error and None if the encoder can't be loaded.
+    """
+    print(f"Evaluating {name}{' (int8)' if quantize else ''}")
+    start = time.perf_counter()
+    try:
+        model = encoders.load_encoder(name, quantize)
+    except Exception as e:
+        print(f"Could not load {name}: {e!r}")
+        return {**encoders.describe(name, quantize), "error": repr(e)}, None
+    load_seconds = time.perf_counter() - start
+
+    # The sentences build_annoy_index indexes
+    indexed = [sentence for sentence in sentences if len(sentence.split()) > 4]
+    start = time.perf_counter()
+    embeddings = model.encode(indexed, batch_size=batch_size)
+    encode_seconds = time.perf_counter() - start
+
+    spec = encoders.get_encoder(name)
+    search = SimilaritySearch(model, spec.dimension, backend=backend)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Hands the embeddings to the build, so it only builds the index
+        embedding_cache = EmbeddingCache(tmp, encoders.cache_name(name, quantize))
+        for sentence, embedding in zip(indexed, embeddings):
+            embedding_cache.put(sentence, embedding)
+        start = time.perf_counter()
+        search.build_annoy_index(sentences, trees, batch_size, embedding_cache=embedding_cache)
+        build_seconds = time.perf_counter() - start
+        search.save(tmp)
+        index_bytes = os.path.getsize(os.path.join(tmp, search.index_file))
+
+    latencies = time_calls(model.encode, questions)
+    neighbours = [
+        [result.index for result in search.nearest(model.encode(question), k)]
+        for question in questions
+    ]
+    report = {
+        **encoders.describe(name, quantize),
+        "load_seconds": load_seconds,
+        "encode_seconds": encode_seconds,
+        "sentences_per_sec": len(indexed) / encode_seconds,
+        "build_seconds": build_seconds,
+        "query_encode": latency_summary(latencies),
+        "index_bytes": index_bytes,
+    }
+    return report, neighbours
+
+
+def agreement(reference: List[List[int]], candidate: List[List[int]]) -> Dict:
+    overlap = [len(set(r) & set(c)) / len(r) for r, c in zip(reference, candidate) if r]
+    top1 = [bool(c) and r[0] == c[0] for r, c in zip(reference, candidate) if r]
+    return {"overlap_at_k": float(np.mean(overlap)), "top1": float(np.mean(top1))}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("path", help="Index directory, e.g. data/shards/jurafsky_and_martin")
+    parser.add_argument(
+        "--encoders",
+        nargs="+",
+        choices=list(encoders.ENCODERS),
+        help="Encoders to compare. Defaults to all of them",
+    )
+    parser.add_argument(
+        "--reference", choices=list(encoders.ENCODERS), help="Defaults to the index's encoder"
+    )
+    parser.add_argument(
+        "--quantize", action="store_true", help="Also measure int8 quantized versions"
+    )
+    parser.add_argument("--questions", default=QUESTIONS_PATH, help="One question per line")
+    parser.add_argument("--k", type=int, default=10, help="Nearest sentences to compare")
+    parser.add_argument(
+        "--sentences", type=int, help="Only use the first this many sentences of the index"
+    )
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--output", help="File to write the JSON results to")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.path, "manifest.json"), "r", encoding="utf8") as f:
+        manifest = json.load(f)
+    store = SentenceStore.load(args.path)
+    sentences = [store[i] for i in range(min(len(store), args.sentences or len(store)))]
+    questions = load_questions(args.questions)
+    reference_name = args.reference or manifest["encoder"]["name"]
+    # Without --reference, measure the encoder exactly as the index was built with it
+    reference_quantized = args.reference is None and manifest["encoder"].get("quantized", False)
+    candidates = [(name, False) for name in args.encoders or encoders.ENCODERS]
+    if args.quantize:
+        candidates += [(name, True) for name, _ in list(candidates)]
+    build = (args.k, manifest["backend"], manifest["trees"], args.batch_size)
+
+    reference, reference_neighbours = evaluate(
+        reference_name, reference_quantized, sentences, questions, *build
+    )
+    if reference_neighbours is None:
+        raise SystemExit(f"Could not load the reference encoder: {reference['error']}")
+    results = {
+        "index": args.path,
+        "sentences": len(sentences),
+        "questions": len(questions),
+        "k": args.k,
+        "reference": reference,
+        "candidates": [],
+    }
+    for name, quantize in candidates:
+        if (name, quantize) == (reference_name, reference_quantized):
+            continue
+        report, neighbours = evaluate(name, quantize, sentences, questions, *build)
+        if neighbours is None:
+            results["candidates"].append(report)
+            continue
+        report["agreement"] = agreement(reference_neighbours, neighbours)
+        report["encode_speedup"] = report["sentences_per_sec"] / reference["sentences_per_sec"]
+        results["candidates"].append(report)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
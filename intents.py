@@ -0,0 +1,266 @@
+"""
+Intent classification backends for the agent.
+
+Every backend has a message(text) method returning a response shaped like Wit.ai's:
+{
+    "text": "What is an HMM?",
+    "intents": [{"id": "question", "name": "question", "confidence": 0.93}, ...],
+    "entities": {"wit$search_query:search_query": [{"value": "HMM", ...}]}
+}
+"""
+import contextvars
+import json
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from wit import Wit
+
+import metrics
+from questionanswer import LRUCache, normalize_query
+
+SEARCH_QUERY_ENTITY = "wit$search_query:search_query"
+# Words that frame a question rather than say what it is about
+QUESTION_WORDS = {
+    "what", "whats", "what's", "is", "are", "was", "were", "a", "an", "the", "how", "does",
+    "do", "did", "can", "could", "would", "you", "please", "tell", "me", "about", "explain",
+    "define", "describe", "why", "when", "which", "who", "where", "i", "we", "mean", "by",
+    "of", "difference", "between", "and", "work", "works", "use",
+}
+
+
+# Runs classifications for classify_concurrently
+_executor = ThreadPoolExecutor(max_workers=16)
+# normalized text -> response, classified ahead of the current request (see prefilled)
+_request_responses: contextvars.ContextVar[Optional[Dict[str, Dict]]] = contextvars.ContextVar(
+    "request_responses", default=None
+)
+
+
+def classify_concurrently(classify: Callable[[str], Dict], texts: List[str]) -> List[Dict]:
+    """Runs classify on all the texts at once, returning the responses in the same order."""
+    return list(_executor.map(metrics.propagate(classify), texts))
+
+
+def classify_in_background(classify: Callable[[str], Dict], text: str) -> Future:
+    """Starts classify on text on the same threads as classify_concurrently."""
+    return _executor.submit(metrics.propagate(classify), text)
+
+
+def empty_response(text: str) -> Dict:
+    """A response with no intents or entities, which the agent treats as fallback."""
+    return {"text": text, "intents": [], "entities": {}}
+
+
+class WitBackend:
+    """
+    Sends text to Wit.ai for classification. The wit client has no timeout of its own,
+    so calls run on a thread pool and raise TimeoutError after timeout seconds.
+    """
+
+    def __init__(self, access_token: str, timeout: float = 5.0):
+        self._wit = Wit(access_token)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=16)
+
+    def message(self, text: str) -> Dict:
+        with metrics.timed("wit"):
+            try:
+                response = self._executor.submit(self._wit.message, text).result(
+                    timeout=self.timeout
+                )
+            except TimeoutError:
+                metrics.WIT_CALLS.inc(outcome="timeout")
+                raise
+            except Exception:
+                metrics.WIT_CALLS.inc(outcome="error")
+                raise
+        metrics.WIT_CALLS.inc(outcome="ok")
+        return response
+
+
+class CachedIntentBackend:
+    """
+    Remembers the responses of another backend, keyed on normalized text, so the same
+    text is never classified twice. Failed calls aren't cached.
+    """
+
+    def __init__(self, backend, maxsize: int = 4096):
+        self.backend = backend
+        self.cache = LRUCache(maxsize, "intents")
+
+    def message(self, text: str) -> Dict:
+        key = normalize_query(text)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.backend.message(text)
+            self.cache.put(key, response)
+        return response
+
+
+class LocalIntentClassifier:
+    """
+    Offline intent classifier. Embeds a handful of example utterances per intent with the
+    sentence embedding model the index already uses, and labels new text with the intents
+    of the most similar examples (cosine similarity). Text that isn't close enough to any
+    example gets no intent, which the agent treats as fallback.
+    """
+
+    def __init__(
+        self,
+        model,
+        examples_path: str = "intent_examples.json",
+        min_confidence: float = 0.5,
+    ):
+        self.model = model
+        self.min_confidence = min_confidence
+        with open(examples_path, encoding="utf8") as fp:
+            examples: Dict[str, List[str]] = json.load(fp)
+        self._labels = [intent for intent, texts in examples.items() for _ in texts]
+        texts = [text for intent_texts in examples.values() for text in intent_texts]
+        self._examples = self._normalize(np.asarray(self.model.encode(texts)))
+
+    @staticmethod
+    def _normalize(vectors):
+        return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+    def message(self, text: str) -> Dict:
+        with metrics.timed("intent_local"):
+            embedding = self._normalize(np.asarray(self.model.encode(text)))
+            similarities = self._examples @ embedding
+        # Score each intent by its closest example
+        scores = {}
+        for label, similarity in zip(self._labels, similarities):
+            scores[label] = max(scores.get(label, -1.0), float(similarity))
+        intents = [
+            {"id": name, "name": name, "confidence": confidence}
+            for name, confidence in sorted(scores.items(), key=lambda item: -item[1])
+            if confidence >= self.min_confidence
+        ]
+        return {
+            "text": text,
+            "intents": intents,
+            "entities": {SEARCH_QUERY_ENTITY: self.search_query_entities(text)},
+        }
+
+    @staticmethod
+    def search_query_entities(text: str) -> List[Dict]:
+        """
+        Guesses the search query by dropping the words that frame the question,
+        e.g. "What is an HMM" -> "HMM". Falls back to the whole text.
+        """
+        words = [word for word in text.split() if word.lower() not in QUESTION_WORDS]
+        value = " ".join(words) if words else text
+        start = text.find(value)
+        return [
+            {
+                "name": "wit$search_query",
+                "role": "search_query",
+                "body": value,
+                "value": value,
+                "start": max(start, 0),
+                "end": max(start, 0) + len(value),
+                "confidence": 1.0,
+            }
+        ]
+
+
+class ExampleIntentClassifier:
+    """
+    Labels text that matches one of the intent examples word for word (ignoring case and
+    punctuation), without a model. Stands in while the real backend is still loading.
+    Any other text gets no intent.
+    """
+
+    def __init__(self, examples_path: str = "intent_examples.json"):
+        with open(examples_path, encoding="utf8") as fp:
+            examples: Dict[str, List[str]] = json.load(fp)
+        self._intents = {
+            self._key(text): intent for intent, texts in examples.items() for text in texts
+        }
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return normalize_query(text).strip("?!.,' ")
+
+    def message(self, text: str) -> Dict:
+        intent = self._intents.get(self._key(text))
+        if intent is None:
+            return empty_response(text)
+        return {
+            "text": text,
+            "intents": [{"id": intent, "name": intent, "confidence": 1.0}],
+            "entities": {},
+        }
+
+
+class FallbackIntentBackend:
+    """
+    Uses the primary backend, but answers with the fallback backend whenever the primary
+    fails or takes longer than latency_budget seconds.
+    """
+
+    def __init__(self, primary, fallback, latency_budget: float = 1.0):
+        self.primary = primary
+        self.fallback = fallback
+        self.latency_budget = latency_budget
+        self._executor = ThreadPoolExecutor(max_workers=8)
+
+    def message(self, text: str) -> Dict:
+        future = self._executor.submit(metrics.propagate(self.primary.message), text)
+        try:
+            return future.result(timeout=self.latency_budget)
+        except TimeoutError:
+            print(f"Intent backend took longer than {self.latency_budget}s, using fallback")
+        except Exception as e:
+            print(f"Intent backend failed ({e}), using fallback")
+        return self.fallback.message(text)
+
+
+@contextmanager
+def prefilled(responses: Dict[str, Dict]):
+    """PrefilledIntentBackend answers with responses (text -> response) inside the with statement."""
+    token = _request_responses.set(
+        {normalize_query(text): response for text, response in responses.items()}
+    )
+    try:
+        yield
+    finally:
+        _request_responses.reset(token)
+
+
+def classified_ahead() -> bool:
+    """Whether the texts of the current turn were classified before it ran (see prefilled)."""
+    return bool(_request_responses.get())
+
+
+class PrefilledIntentBackend:
+    """
+    Lets the async server (asgi_app.py) classify a turn's texts itself, awaiting Wit.ai
+    without holding a thread, before the turn runs synchronously on a worker thread.
+    Responses it got from Wit.ai are put here and answered for every request after.
+    Stand-ins for failed calls are passed through prefilled and only last for that turn.
+    Anything else goes to backend.
+    """
+
+    def __init__(self, backend, maxsize: int = 4096):
+        self.backend = backend
+        self.cache = LRUCache(maxsize, "prefilled_intents")
+
+    def put(self, text: str, response: Dict) -> None:
+        self.cache.put(normalize_query(text), response)
+
+    def get(self, text: str) -> Optional[Dict]:
+        """The response Wit.ai gave for text before, or None."""
+        return self.cache.get(normalize_query(text))
+
+    def message(self, text: str) -> Dict:
+        key = normalize_query(text)
+        responses = _request_responses.get()
+        if responses is not None and key in responses:
+            return responses[key]
+        response = self.cache.get(key)
+        if response is None:
+            response = self.backend.message(text)
+        return response
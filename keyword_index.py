@@ -0,0 +1,142 @@
+"""
+BM25 inverted index over the indexed sentences, built and saved next to the embedding index.
+
+Short keyword queries ("HMM", "Viterbi", "perplexity") are answered from it without running
+the encoder. Longer queries get the embedding search results fused with its results
+(see fuse_results). Sentence embeddings tend to handle rare terms and acronyms poorly, and
+exact term matches catch those.
+"""
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+from backends import replace_file
+
+TOKEN_REGEX = re.compile(r"[a-z0-9]+(?:[-'][a-z0-9]+)*")
+# Words too common to say what a query is about
+STOPWORDS = {
+    "a", "about", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from",
+    "how", "i", "in", "is", "it", "its", "me", "of", "on", "or", "that", "the", "their", "them",
+    "these", "they", "this", "to", "was", "we", "were", "what", "when", "where", "which", "who",
+    "why", "with", "you",
+}
+# Constant of reciprocal rank fusion. Higher values flatten the difference between ranks.
+RRF_K = 60
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms of text without stopwords, with plural and possessive s's stripped."""
+    tokens = []
+    for token in TOKEN_REGEX.findall(text.lower()):
+        if token.endswith("'s"):
+            token = token[:-2]
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def is_keyword_query(query: str, max_terms: int = 2) -> bool:
+    """Whether query is just a term or two, short enough to answer from the keyword index."""
+    return 0 < len(tokenize(query)) <= max_terms
+
+
+def fuse_results(*result_lists, n: int):
+    """
+    Merges ranked lists of SearchResults with reciprocal rank fusion, keeping the best n.
+    Results are matched up by source and sentence index. Fused results are ranked by their
+    negated fusion score in distance, so lower still means better.
+    """
+    scores = defaultdict(float)
+    results = {}
+    for result_list in result_lists:
+        for rank, result in enumerate(result_list):
+            key = (result.source, result.index)
+            scores[key] += 1 / (RRF_K + rank + 1)
+            results.setdefault(key, result)
+    best = sorted(scores, key=lambda key: -scores[key])[:n]
+    return [results[key]._replace(distance=-scores[key]) for key in best]
+
+
+class KeywordIndex:
+    """
+    Postings are stored in compressed sparse row form: the postings of the term in row r are
+    ids[offsets[r]:offsets[r + 1]], each with its precomputed BM25 weight in weights.
+    """
+
+    def __init__(self, terms: List[str], offsets, ids, weights):
+        self.vocabulary = {term: row for row, term in enumerate(terms)}
+        self.terms = terms
+        self.offsets = offsets
+        self.ids = ids
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.terms)
+
+    @classmethod
+    def build(
+        cls, sentences: Iterable[Tuple[int, str]], k1: float = 1.2, b: float = 0.75
+    ) -> "KeywordIndex":
+        """Indexes (sentence id, text) pairs with BM25 parameters k1 and b."""
+        postings = defaultdict(list)
+        lengths = {}
+        for i, text in sentences:
+            tokens = tokenize(text)
+            lengths[i] = len(tokens)
+            for term, count in Counter(tokens).items():
+                postings[term].append((i, count))
+        n_docs = len(lengths)
+        average_length = sum(lengths.values()) / n_docs if n_docs else 0.0
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        ids, weights = [], []
+        for row, term in enumerate(terms):
+            term_postings = postings[term]
+            df = len(term_postings)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for i, tf in term_postings:
+                norm = k1 * (1 - b + b * lengths[i] / average_length)
+                ids.append(i)
+                weights.append(idf * tf * (k1 + 1) / (tf + norm))
+            offsets[row + 1] = len(ids)
+        return cls(
+            terms, offsets, np.asarray(ids, dtype=np.int64), np.asarray(weights, dtype=np.float32)
+        )
+
+    def search(self, query: str, n: int) -> Tuple[List[int], List[float]]:
+        """Ids and BM25 scores of the n best matching sentences, best first."""
+        rows = [self.vocabulary[term] for term in set(tokenize(query)) if term in self.vocabulary]
+        if not rows:
+            return [], []
+        ids = np.concatenate([self.ids[self.offsets[r] : self.offsets[r + 1]] for r in rows])
+        weights = np.concatenate([self.weights[self.offsets[r] : self.offsets[r + 1]] for r in rows])
+        # Add up the weights of each sentence's matching terms
+        unique_ids, inverse = np.unique(ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights)
+        best = np.argsort(-scores, kind="stable")[:n]
+        return unique_ids[best].tolist(), scores[best].tolist()
+
+    def save(self, path: str) -> None:
+        replace_file(
+            os.path.join(path, "keywords.npz"),
+            lambda f: np.savez(f, offsets=self.offsets, ids=self.ids, weights=self.weights),
+        )
+        replace_file(
+            os.path.join(path, "keywords.json"),
+            lambda f: f.write(json.dumps(self.terms).encode("utf8")),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "KeywordIndex":
+        with open(os.path.join(path, "keywords.json"), "r", encoding="utf8") as f:
+            terms = json.load(f)
+        with np.load(os.path.join(path, "keywords.npz")) as arrays:
+            return cls(terms, arrays["offsets"], arrays["ids"], arrays["weights"])
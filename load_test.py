@@ -0,0 +1,239 @@
+#! /usr/bin/env python
+"""
+Load test for the dialogue server: many simulated students replaying scripted conversations.
+
+python wit_stub.py --port 8001 --latency 0.05
+WIT_URL=http://localhost:8001 python qa_web_app.py --workers 4
+python load_test.py --url http://localhost:5000 --rate 5 --students 300 --concurrency 100
+
+Conversations are read from data/load_test_conversations.json: a list of
+{"name": ..., "turns": [{"say": "What is an HMM?", "state": "QA-ing"}, ...]}, covering
+multiple questions, yes/no follow ups, anaphora and exits. Each student picks one at random
+and sends its turns to /ask one after another on its own session, pausing think_time seconds
+on average between them. Students start at --rate per second whether or not earlier ones have
+finished, up to --concurrency at a time, so a server that falls behind shows up as start lag.
+
+After every turn, the dialogue state the server reports in the X-Dialogue-State header is
+checked against the state the script expects. The report (JSON) has throughput, latency
+percentiles, error rates by kind and every conversation whose states went wrong. The exit
+status is 1 if there were errors or wrong states.
+
+With --in-process, the app runs in this process with StubWitBackend instead, and is called
+through Flask's test client.
+"""
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from benchmark import latency_summary
+
+CONVERSATIONS_PATH = "data/load_test_conversations.json"
+# Sends a message on a session, returning the status code and the reported dialogue state
+Ask = Callable[[str, str], Tuple[int, Optional[str]]]
+
+
+def load_conversations(path: str = CONVERSATIONS_PATH) -> List[Dict]:
+    with open(path, "r", encoding="utf8") as f:
+        return json.load(f)
+
+
+def http_ask(url: str, timeout: float) -> Ask:
+    """Posts to the /ask endpoint of the server at url, with a connection pool per thread."""
+    import requests
+
+    local = threading.local()
+
+    def ask(question: str, session_id: str):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        response = local.session.post(
+            url.rstrip("/") + "/ask",
+            json={"question": question, "session_id": session_id},
+            timeout=timeout,
+        )
+        return response.status_code, response.headers.get("X-Dialogue-State")
+
+    return ask
+
+
+def in_process_ask(wit_latency: float) -> Ask:
+    """Calls /ask on an app in this process, with Wit.ai replaced by StubWitBackend."""
+    import qa_web_app
+    from wit_stub import StubWitBackend
+
+    app = qa_web_app.create_app(nlu=StubWitBackend(wit_latency), debug=False)
+
+    def ask(question: str, session_id: str):
+        response = app.test_client().post(
+            "/ask", json={"question": question, "session_id": session_id}
+        )
+        return response.status_code, response.headers.get("X-Dialogue-State")
+
+    return ask
+
+
+def run_student(ask: Ask, conversation: Dict, think_time: float, due: float) -> Dict:
+    """
+    Plays one conversation on a new session. Stops at the first error, since the session's
+    state is unknown after it.
+    """
+    started = time.perf_counter()
+    session_id = uuid.uuid4().hex
+    turns = []
+    error = None
+    for i, turn in enumerate(conversation["turns"]):
+        if i and think_time:
+            time.sleep(random.expovariate(1 / think_time))
+        start = time.perf_counter()
+        try:
+            status, state = ask(turn["say"], session_id)
+            error = None if status == 200 else f"http_{status}"
+        except Exception as e:
+            state, error = None, type(e).__name__
+        turns.append(
+            {
+                "say": turn["say"],
+                "seconds": time.perf_counter() - start,
+                "error": error,
+                "expected": turn.get("state"),
+                "state": state,
+            }
+        )
+        if error is not None:
+            break
+    return {
+        "conversation": conversation["name"],
+        "start_lag": started - due,
+        "completed": error is None,
+        "turns": turns,
+    }
+
+
+def run(
+    ask: Ask,
+    conversations: List[Dict],
+    students: int,
+    rate: float,
+    concurrency: int,
+    think_time: float = 0.0,
+    seed: Optional[int] = None,
+) -> Tuple[List[Dict], float]:
+    """Starts students at rate per second. Returns their results and the seconds taken."""
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    futures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(students):
+            due = start + i / rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(
+                executor.submit(run_student, ask, rng.choice(conversations), think_time, due)
+            )
+        results = [future.result() for future in futures]
+    return results, time.perf_counter() - start
+
+
+def summarize(results: List[Dict], seconds: float, rate: float) -> Dict:
+    turns = [turn for result in results for turn in result["turns"]]
+    errors = Counter(turn["error"] for turn in turns if turn["error"] is not None)
+    checked = [turn for turn in turns if turn["error"] is None and turn["expected"] is not None]
+    wrong_states = []
+    for result in results:
+        for i, turn in enumerate(result["turns"]):
+            if turn["error"] is None and turn["expected"] not in (None, turn["state"]):
+                wrong_states.append(
+                    {
+                        "conversation": result["conversation"],
+                        "turn": i,
+                        "say": turn["say"],
+                        "expected": turn["expected"],
+                        "state": turn["state"],
+                    }
+                )
+                # Later turns of a session that went wrong would just repeat the failure
+                break
+    by_conversation = Counter(result["conversation"] for result in results)
+    wrong_by_conversation = Counter(wrong["conversation"] for wrong in wrong_states)
+    return {
+        "students": len(results),
+        "target_students_per_sec": rate,
+        "completed": sum(result["completed"] for result in results),
+        "requests": len(turns),
+        "seconds": seconds,
+        "requests_per_sec": len(turns) / seconds if seconds else 0.0,
+        "latency": latency_summary([turn["seconds"] for turn in turns]) if turns else None,
+        "start_lag": latency_summary([max(result["start_lag"], 0) for result in results])
+        if results
+        else None,
+        "errors": {
+            "count": sum(errors.values()),
+            "rate": sum(errors.values()) / len(turns) if turns else 0.0,
+            "by_kind": dict(errors),
+        },
+        "states": {
+            "checked": len(checked),
+            "wrong_sessions": len(wrong_states),
+            "by_conversation": {
+                name: {"sessions": count, "wrong": wrong_by_conversation[name]}
+                for name, count in sorted(by_conversation.items())
+            },
+            "wrong": wrong_states,
+        },
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5000", help="Dialogue server to test")
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Test an app in this process with the Wit.ai stub instead of a server",
+    )
+    parser.add_argument("--conversations", default=CONVERSATIONS_PATH, help="Conversation scripts")
+    parser.add_argument("--students", type=int, default=100, help="Conversations to play in total")
+    parser.add_argument("--rate", type=float, default=5.0, help="New students per second")
+    parser.add_argument(
+        "--concurrency", type=int, default=50, help="Most students in conversation at once"
+    )
+    parser.add_argument(
+        "--think-time", type=float, default=0.0, help="Mean seconds a student waits between turns"
+    )
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait per request")
+    parser.add_argument(
+        "--wit-latency", type=float, default=0.0, help="Seconds the in-process Wit.ai stub waits"
+    )
+    parser.add_argument("--seed", type=int, help="Seed for picking conversations")
+    parser.add_argument("--output", help="File to write the JSON report to")
+    args = parser.parse_args()
+
+    conversations = load_conversations(args.conversations)
+    if args.in_process:
+        ask = in_process_ask(args.wit_latency)
+    else:
+        ask = http_ask(args.url, args.timeout)
+    results, seconds = run(
+        ask, conversations, args.students, args.rate, args.concurrency, args.think_time, args.seed
+    )
+    report = summarize(results, seconds, args.rate)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            f.write(output)
+    print(output)
+    if report["errors"]["count"] or report["states"]["wrong_sessions"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Counters, gauges and latency histograms for the hot path, rendered in Prometheus text
+format for the /metrics endpoint.
+
+Stages are timed with `with timed("encode"):`. Besides feeding the stage histogram, timed
+stages are added to the current request's trace when one was started with start_trace,
+so a single request can report where its time went.
+"""
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (stage, seconds) pairs recorded for the current request, if it is being traced
+_trace: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    "trace", default=None
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels.items())
+    return "{" + pairs + "}"
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], **extra) -> str:
+        return _format_labels({**dict(zip(self.labelnames, key)), **extra})
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in values]
+
+
+class Gauge(Counter):
+    """A value that can go up and down. Either set directly or read from a callback."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(name, help, labelnames)
+        self._callback = callback
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        if self._callback is not None:
+            self.set(self._callback())
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> (count per bucket, with a last one for +Inf, sum of observations)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{self._labels(key, le=le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = (), callback=None) -> Gauge:
+        return self.register(Gauge(name, help, labelnames, callback))
+
+    def histogram(
+        self, name: str, help: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "atam_stage_seconds", "Time spent in each stage of answering a question", ["stage"]
+)
+WIT_CALLS = REGISTRY.counter("atam_wit_calls_total", "Calls to Wit.ai by outcome", ["outcome"])
+CACHE_REQUESTS = REGISTRY.counter(
+    "atam_cache_requests_total", "Cache lookups by cache and result", ["cache", "result"]
+)
+INTENTS = REGISTRY.counter("atam_intents_total", "Classified intents of user messages", ["intent"])
+STATE_TRANSITIONS = REGISTRY.counter(
+    "atam_state_transitions_total", "Dialogue state changes", ["from_state", "to_state"]
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "atam_request_seconds", "Request latency by endpoint", ["endpoint"]
+)
+REQUESTS = REGISTRY.counter(
+    "atam_requests_total", "Requests by endpoint and status code", ["endpoint", "status"]
+)
+SEARCH_ROUTES = REGISTRY.counter(
+    "atam_search_routes_total",
+    "Searches by how they were answered (keyword, hybrid or embedding)",
+    ["route"],
+)
+ENCODE_BATCH_SIZE = REGISTRY.histogram(
+    "atam_encode_batch_size",
+    "Queries per micro-batch encoded and searched together (see QueryBatcher)",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+ENCODE_QUEUE_SECONDS = REGISTRY.histogram(
+    "atam_encode_queue_seconds", "Time queries waited for their micro-batch to start"
+)
+CONVERSATION_LOG_RECORDS = REGISTRY.counter(
+    "atam_conversation_log_records_total",
+    "Conversation log records by outcome (written, dropped or error)",
+    ["outcome"],
+)
+
+
+def start_trace() -> List[Tuple[str, float]]:
+    """Starts recording timed stages for the current request and returns the record."""
+    trace = []
+    _trace.set(trace)
+    return trace
+
+
+def end_trace() -> None:
+    _trace.set(None)
+
+
+def record(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = _trace.get()
+    if trace is not None:
+        trace.append((stage, seconds))
+
+
+@contextmanager
+def timed(stage: str):
+    """Times the body of the with statement as stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def propagate(func: Callable) -> Callable:
+    """
+    Wraps func to run in the caller's context, so stages it times on another thread
+    (e.g. in a thread pool) still end up in the caller's trace.
+    """
+    context = contextvars.copy_context()
+    # A context can only be entered by one thread at a time, so each call runs in a copy.
+    # The copies all hold the same trace list.
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
@@ -1,31 +1,346 @@
 """
 Web app that receives questions in JSON objects of the form:
 {
-    "question": "What is an HMM?"
+    "question": "What is an HMM?",
+    "session_id": "3f0c2a..."
 }
 
 by a POST request to '/ask'.
 
-The app sends back an answer as a string.
+The app sends back an answer as a string. Each session_id gets its own dialogue state.
+If the session_id is left out, a new session is started and its id is sent back in
+the X-Session-Id response header. The X-Dialogue-State header has the session's dialogue
+state after the turn, which load_test.py checks.
+
+The app is built by create_app. `python qa_web_app.py --workers 4` serves it with
+gunicorn, loading the model and index once and forking workers that share them.
+With --lazy, the port is bound straight away and the model and index load in the
+background; /healthz and /readyz report on the process and on loading.
+`python qa_web_app.py --snapshot` saves a warm start snapshot (the model and built index
+shards) that later starts load straight from disk.
 """
+import atexit
+import gc
+import hashlib
 import os
+import shutil
+import threading
+import time
+import uuid
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Dict, List
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
 
-from sentence_transformers import SentenceTransformer
-from wit import Wit
 import random
 import json
-from flask import Flask, request
+from flask import Blueprint, Flask, current_app, request, make_response, g, Response, jsonify
 from flask_cors import CORS
 
-from questionanswer import SimilaritySearch, Preprocessor
+import encoders
+import metrics
+from conversation_log import ConversationLog
+
+from intents import (
+    WitBackend,
+    LocalIntentClassifier,
+    ExampleIntentClassifier,
+    FallbackIntentBackend,
+    CachedIntentBackend,
+    PrefilledIntentBackend,
+    classified_ahead,
+    classify_concurrently,
+    classify_in_background,
+    empty_response,
+)
+from questionanswer import (
+    ChunkCursor,
+    LRUCache,
+    QueryBatcher,
+    ShardedSearch,
+    SearchResult,
+    normalize_query,
+)
+
+routes = Blueprint("atam", __name__)
+
+
+# Reference material to search. Each entry gets its own index shard in data/shards/<name>:
+# shard name -> (title used when citing it, text files)
+REFERENCE_SOURCES = {
+    "jurafsky_and_martin": (
+        "Speech and Language Processing (Jurafsky & Martin)",
+        ["data/cleaned_jurafsky_and_martin.txt"],
+    ),
+}
+# Sentence encoder for the index and questions, one of encoders.ENCODERS
+ENCODER = os.environ.get("ATAM_ENCODER", encoders.DEFAULT_ENCODER)
+# Quantize the encoder to int8 for faster CPU inference (ATAM_QUANTIZE_ENCODER=1)
+QUANTIZE_ENCODER = os.environ.get("ATAM_QUANTIZE_ENCODER", "") == "1"
+# Compression of the index embeddings, e.g. {"normalize": True, "pca_dim": 256, "quantize": "int8"}.
+# See compression.py. None keeps full size float32 embeddings in a euclidean index.
+INDEX_COMPRESSION = None
+# Questions from concurrent requests are encoded and searched in micro-batches (see
+# QueryBatcher): a batch starts this many seconds after its first question, or once it has
+# ENCODE_BATCH_MAX questions. ATAM_ENCODE_BATCH_MAX=1 turns batching off.
+ENCODE_BATCH_WINDOW = float(os.environ.get("ATAM_ENCODE_BATCH_WINDOW", "0.002"))
+ENCODE_BATCH_MAX = int(os.environ.get("ATAM_ENCODE_BATCH_MAX", "32"))
+# Most questions answered by one /ask_batch request, which are all encoded in one batch
+MAX_BATCH_QUESTIONS = 32
+# Most nearest sentences to offer chunks around before giving up on a question
+REFERENCE_DEPTH = 10
+# Idle sessions are dropped after this many seconds
+SESSION_TTL = 30 * 60
+# Least recently used sessions are dropped once all dialogue state passes this many bytes
+SESSION_MEMORY_LIMIT = 64 * 1024 * 1024
+# Where sessions are kept when serving from several worker processes
+SESSION_DIR = "sessions"
+# Append-only JSON lines log of conversations, see conversation_log.py
+CONVERSATION_LOG_PATH = "logs/conversations.jsonl"
+# Added to logged questions once we know whether they were answered
+ANSWERED_NOTE = "\t\t(I think I answered this one)"
+UNANSWERED_NOTE = "\t\t(I didn't answer this one)"
+# Background threads shared by all agents for prefetching answers to pending questions
+PREFETCH_THREADS = 4
+# Most prefetched classifications kept, for all sessions together
+PREFETCH_CACHE_SIZE = 1024
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_THREADS)
+# Normalized pending question -> future of its wit response. Kept per process rather than per
+# agent, since FileSessionStore makes a new agent every turn. The search results a prefetch
+# finds are kept in the search's result cache.
+_prefetched = LRUCache(PREFETCH_CACHE_SIZE, "prefetched_answers")
+# Which intent classifier to use: "wit", "local" (offline, no Wit.ai calls) or
+# "fallback" (Wit.ai, switching to the local classifier when Wit is slow or down)
+INTENT_BACKEND = os.environ.get("ATAM_INTENT_BACKEND", "wit")
+# Seconds to wait for Wit.ai before the fallback backend answers instead
+WIT_LATENCY_BUDGET = float(os.environ.get("ATAM_WIT_LATENCY_BUDGET", "1.0"))
+# Seconds before a Wit.ai call is abandoned
+WIT_TIMEOUT = float(os.environ.get("ATAM_WIT_TIMEOUT", "5.0"))
+# Number of classified messages remembered by each intent backend
+INTENT_CACHE_SIZE = 4096
+# Index shards, built from REFERENCE_SOURCES when there's no warm start snapshot
+SHARDS_DIR = os.path.join("data", "shards")
+# Warm start snapshot: a saved copy of the encoder's model and the built index shards, loaded
+# instead of downloading the model and checking the shards when present (see save_warm_start)
+WARM_START_DIR = os.path.join("data", "warm_start")
+# Encoded and searched once at startup so the first real question isn't slowed by cold caches
+WARM_UP_QUESTION = "What is a language model?"
+# Intents answered while the model and index are still loading. The rest need the search.
+STARTUP_INTENTS = {
+    "greeting", "exit", "name", "personal", "weather", "time_related", "want_ta", "grades", "assignment",
+}
+NOT_READY_ANSWER = "I'm still getting ready. Please ask me again in a few seconds."
+
+
+def read_warm_start() -> Optional[Dict]:
+    """The warm start snapshot's description, if there is one for the ENCODER's model."""
+    snapshot_path = os.path.join(WARM_START_DIR, "warm_start.json")
+    if not os.path.exists(snapshot_path):
+        return None
+    with open(snapshot_path, encoding="utf8") as f:
+        snapshot = json.load(f)
+    if snapshot.get("model") != encoders.get_encoder(ENCODER).model:
+        print("Warm start snapshot is for a different model, ignoring it")
+        return None
+    return snapshot
+
+
+def load_model(snapshot: Optional[Dict] = None):
+    """
+    The ENCODER's sentence embedding model, from the warm start snapshot if given (see
+    read_warm_start). Loading the saved copy skips resolving and checking the model online.
+    The snapshot holds the full precision model, which is quantized after loading if need be.
+    """
+    if snapshot is not None:
+        return encoders.load_encoder(ENCODER, QUANTIZE_ENCODER, os.path.join(WARM_START_DIR, "model"))
+    return encoders.load_encoder(ENCODER, QUANTIZE_ENCODER)
+
 
-app = Flask(__name__)
-CORS(app)
+def load_shards(search: ShardedSearch, snapshot: Optional[Dict] = None) -> Dict[str, str]:
+    """
+    Loads a shard for each of the REFERENCE_SOURCES into search. Shards come from the warm
+    start snapshot if given and it has them up to date. The others come from SHARDS_DIR,
+    (re)built there if they don't exist or their text changed: only save_warm_start writes to
+    the snapshot. Returns the directory each shard was loaded from.
+    """
+    paths = {}
+    options = {"encoder": ENCODER, "quantize_encoder": QUANTIZE_ENCODER}
+    for name, (title, sources) in REFERENCE_SOURCES.items():
+        if snapshot is not None and name in snapshot.get("shards", []):
+            path = os.path.join(WARM_START_DIR, "shards", name)
+            if search.load_or_build_shard(name, sources, path, title, build=False, **options):
+                paths[name] = path
+                continue
+            print(f"Warm start snapshot's {name} shard can't be used, loading it from {SHARDS_DIR}")
+        path = os.path.join(SHARDS_DIR, name)
+        search.load_or_build_shard(name, sources, path, title, **options)
+        paths[name] = path
+    return paths
+
+
+def save_warm_start() -> None:
+    """
+    Saves a snapshot to WARM_START_DIR: the model, and a copy of every index shard, built
+    in SHARDS_DIR first if missing or out of date. The shards are the files SimilaritySearch.load memory
+    maps, without the embedding caches only rebuilds need, so a deploy can ship the
+    directory and start without downloading the model or building anything.
+    The snapshot is written next to the old one and swapped in at the end, so a server
+    starting meanwhile sees one or the other, never half of each.
+    """
+    model_name = encoders.get_encoder(ENCODER).model
+    staging = WARM_START_DIR + ".new"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    model = encoders.load_encoder(ENCODER)
+    model.save(os.path.join(staging, "model"))
+    if QUANTIZE_ENCODER:
+        model = encoders.quantize_model(model)
+    search = ShardedSearch(
+        model, encoders.get_encoder(ENCODER).dimension, compression=INDEX_COMPRESSION
+    )
+    paths = load_shards(search, read_warm_start())
+    for name, path in paths.items():
+        shutil.copytree(
+            path, os.path.join(staging, "shards", name), ignore=shutil.ignore_patterns("cache")
+        )
+    with open(os.path.join(staging, "warm_start.json"), "w", encoding="utf8") as f:
+        json.dump(
+            {
+                "encoder": ENCODER,
+                "model": model_name,
+                "shards": list(paths),
+                "created": time.time(),
+            },
+            f,
+        )
+    shutil.rmtree(WARM_START_DIR, ignore_errors=True)
+    os.rename(staging, WARM_START_DIR)
+    print(f"Saved warm start snapshot to {WARM_START_DIR}")
 
 
-REFERENCE_TEXT_PATH = "data/cleaned_jurafsky_and_martin.txt"
+def warm_up(search) -> None:
+    """Runs an encode and a search without the caches, loading weights and index pages."""
+    start = time.perf_counter()
+    search.nearest(search.model.encode(WARM_UP_QUESTION), 1)
+    print(f"Warmed up in {time.perf_counter() - start:.2f}s")
+
+
+def load_search() -> ShardedSearch:
+    """
+    Loads the sentence embedding model and an index shard for each of the REFERENCE_SOURCES
+    (see load_shards). Both come from the warm start snapshot when there is one. The result
+    is read-only and shared by every session.
+    """
+    snapshot = read_warm_start()
+    model = load_model(snapshot)
+    search = ShardedSearch(
+        model, encoders.get_encoder(ENCODER).dimension, compression=INDEX_COMPRESSION
+    )
+    load_shards(search, snapshot)
+    if ENCODE_BATCH_MAX > 1:
+        search.batcher = QueryBatcher(search, ENCODE_BATCH_WINDOW, ENCODE_BATCH_MAX)
+    return search
+
+
+def read_access_token() -> str:
+    try:
+        with open("atam_client_access_token.secret", encoding="utf8") as secret_file:
+            '''Please ensure'''
+            return secret_file.read()
+    except:
+        print("ATAM Python service failed: Please include atam_client_access_token.secret in project root directory with Wit.AI client key")
+        exit(1)
+
+
+def load_intent_backend(model):
+    """
+    Builds the intent classifier selected by INTENT_BACKEND. Each backend caches its own
+    responses, so a Wit.ai call that outlives the latency budget still fills the cache.
+    """
+    if INTENT_BACKEND == "local":
+        return CachedIntentBackend(LocalIntentClassifier(model), INTENT_CACHE_SIZE)
+    wit_backend = CachedIntentBackend(
+        WitBackend(read_access_token(), WIT_TIMEOUT), INTENT_CACHE_SIZE
+    )
+    if INTENT_BACKEND == "fallback":
+        local_backend = CachedIntentBackend(LocalIntentClassifier(model), INTENT_CACHE_SIZE)
+        return FallbackIntentBackend(wit_backend, local_backend, WIT_LATENCY_BUDGET)
+    return wit_backend
+
+
+def load_hardcoded_responses() -> Dict[str, List[str]]:
+    """Provides a dictionary from intentions to hardcoded responses."""
+    with open("responses.json", encoding="utf8") as fp:
+        return json.load(fp)
+
+
+class NotReady(Exception):
+    """Raised when the search is used before it has finished loading."""
+
+
+class _LoadingSearch:
+    """Stands in for the search until BackgroundLoader has loaded it."""
+
+    def __init__(self, loader):
+        self._loader = loader
+
+    def __getattr__(self, name):
+        if not self._loader.ready.is_set():
+            raise NotReady("The search index is still loading")
+        return getattr(self._loader.loaded_search, name)
+
+
+class BackgroundLoader:
+    """
+    Loads the search and intent backend on a background thread so the app can start serving
+    straight away. Hand agents loader.search and the loader itself as their intent backend:
+    until loading is done, search raises NotReady and messages are classified by
+    ExampleIntentClassifier, which is enough for greetings and goodbyes.
+    """
+
+    def __init__(self, search=None, nlu=None):
+        self.loaded_search = search
+        self.loaded_nlu = nlu
+        self.search = _LoadingSearch(self)
+        self.startup_nlu = ExampleIntentClassifier()
+        self.ready = threading.Event()
+        self.error = None
+
+    def start(self) -> None:
+        threading.Thread(target=self._load, name="loader", daemon=True).start()
+
+    def _load(self) -> None:
+        start = time.perf_counter()
+        try:
+            if self.loaded_search is None:
+                self.loaded_search = load_search()
+            if self.loaded_nlu is None:
+                self.loaded_nlu = load_intent_backend(self.loaded_search.model)
+            warm_up(self.loaded_search)
+        except BaseException as e:
+            # BaseException, since read_access_token exits when the secret is missing
+            self.error = repr(e)
+            print(f"Loading failed: {self.error}")
+            return
+        self.ready.set()
+        print(f"Ready in {time.perf_counter() - start:.1f}s")
+
+    def message(self, text: str) -> Dict:
+        if self.ready.is_set():
+            return self.loaded_nlu.message(text)
+        return self.startup_nlu.message(text)
+
+    def can_answer(self, text: str) -> bool:
+        """Whether text can be answered yet: always once loaded, only STARTUP_INTENTS before."""
+        if self.ready.is_set():
+            return True
+        questions = split_questions(text)
+        if len(questions) != 1:
+            return False
+        intent = Agent.get_most_likely_intent(self.startup_nlu.message(questions[0]))
+        return intent["name"] in STARTUP_INTENTS
 
 
 class Agent:
@@ -35,6 +350,8 @@ class Agent:
     YES_INTENT = "yes"
     NO_INTENT = "no"
     YES_NO_INTENTS = {YES_INTENT, NO_INTENT}
+    # First words of replies that are plainly a yes or no, like "yes it helped"
+    YES_NO_WORDS = {"yes", "yeah", "yep", "yup", "sure", "ok", "okay", "no", "nope", "nah"}
     FALLBACK_INTENT = "fallback"
     GRADES = "grades"
     ASSIGNMENT = "assignment"
@@ -52,36 +369,25 @@ class Agent:
     FIRST_OF_MULTI = "first_of_multi"
     # After answering the first of multiple questions, with questions left unanswered
     PENDING_FOLLOW_UP = "pending_follow_up"
-    EMBEDDING_SIZE = 768    # Sentence embedding size
 
-    def __init__(self, atam_client_access_token, debug=True):
+    def __init__(self, nlu, search, hardcoded_responses, debug=True, conversation_log=None):
+        """
+        One Agent holds the dialogue state for a single session. The intent backend (nlu),
+        search index, hardcoded responses and conversation log are shared between all agents.
+        """
         self.reset_state()
-        self._wit = Wit(atam_client_access_token)
+        # Set by the session store, for the conversation log
+        self.session_id = None
+        self._conversation_log = conversation_log
+        self._nlu = nlu
         # Set debug mode to indicate whether to log full response from wit.ai
         self._debug = debug
-
-        # Provides a dictionary from intentions to hardcoded responses.
-        with open("responses.json", encoding="utf8") as fp:
-            self._hardcoded_responses = json.load(fp)
-
-        # Similarity stuff
-        model = SentenceTransformer("bert-base-nli-mean-tokens")
-        size = self.EMBEDDING_SIZE
-        self.search = SimilaritySearch(model, size)
-
-        if not os.path.exists("data/index.ann"):
-            print("Index doesn't exist. Creating an index...")
-            print("Preprocessing...")
-            preprocessor = Preprocessor()
-            sentences = preprocessor.preprocess_text(REFERENCE_TEXT_PATH)
-            self.search.build_annoy_index(sentences)
-            self.search.save("data")
-        else:
-            print("Loading the index")
-            self.search.load("data")
+        self._hardcoded_responses = hardcoded_responses
+        self.search = search
 
     def reset_state(self):
         """Reset dialog state. Called on initialization and when the user types 'exit' or otherwise indicates exit intent"""
+        self.cancel_prefetch()
         self._q_history = []
         self._last_q = ""
         self._last_intent = ""
@@ -92,9 +398,56 @@ class Agent:
         self.pending_Qs = []
         # track whatever state the agent is currently in
         self.current_state = self.INTRO
-        self.responses = []
+        # ChunkCursor over the reference chunks for the question being answered, if any
+        self.responses = None
         # track inputs stored by intent
         self.log = defaultdict(list)
+        self._started = time.time()
+
+    def prefetch(self, questions):
+        """
+        Starts classifying and searching for questions in the background, so answering them
+        later doesn't have to wait. Prefetches are shared by every session in the process.
+        """
+        for question in questions:
+            key = normalize_query(question)
+            if key not in _prefetched:
+                # In the caller's context, to see intents prefilled for this turn (asgi_app.py)
+                _prefetched.put(
+                    key, _prefetch_executor.submit(metrics.propagate(self._prefetch_one), question)
+                )
+
+    def _prefetch_one(self, question):
+        response = self.classify(question)
+        if Agent.get_most_likely_intent(response)["name"] == self.QUESTION_INTENT:
+            results = self.lookup_reference_answer(response.get("entities"))
+            if results is not None:
+                # Fills the search's result cache for take_prefetched's cursor
+                results.prefetch()
+        return response
+
+    def take_prefetched(self, question):
+        """
+        The prefetched (wit response, chunk cursor) for question, waiting for it if it's
+        still running. None if question wasn't prefetched or the prefetch failed.
+        """
+        future = _prefetched.get(normalize_query(question))
+        if future is None or future.cancelled():
+            return None
+        try:
+            response = future.result()
+        except Exception as e:
+            print(f"Prefetching {question!r} failed: {e!r}")
+            return None
+        results = None
+        if Agent.get_most_likely_intent(response)["name"] == self.QUESTION_INTENT:
+            results = self.lookup_reference_answer(response.get("entities"))
+        return response, results
+
+    def cancel_prefetch(self):
+        """Cancels prefetching this session's pending questions."""
+        # Before reset_state first sets it, pending_Qs is only the method of that name
+        cancel_prefetch(vars(self).get("pending_Qs", []))
 
     def __str__(self):
         return json.dumps(
@@ -117,6 +470,55 @@ class Agent:
                 "confidence": 1.0,
             }
 
+    @classmethod
+    def may_need_resolution(cls, wit_response) -> bool:
+        """Whether a message with anaphora and this classification gets its anaphora resolved."""
+        return cls.get_most_likely_intent(wit_response)["name"] in (cls.QUESTION_INTENT, cls.FALLBACK_INTENT)
+
+    @classmethod
+    def is_yes_no_reply(cls, text) -> bool:
+        """Whether text starts with a plain yes or no, like "yes it helped", which is rarely resolved."""
+        words = text.lower().split()
+        return bool(words) and words[0].strip(",.!") in cls.YES_NO_WORDS
+
+    def get_state(self) -> Dict:
+        """The dialogue state as JSON serializable data, see set_state."""
+        return {
+            "q_history": self._q_history,
+            "last_q": self._last_q,
+            "last_intent": self._last_intent,
+            "qud": list(self._qud),
+            "pending_Qs": self.pending_Qs,
+            "current_state": self.current_state,
+            "responses": self.responses.get_state() if self.responses is not None else None,
+            "log": dict(self.log),
+            "started": self._started,
+        }
+
+    def set_state(self, state: Dict) -> None:
+        """Restores dialogue state saved by get_state."""
+        self._q_history = state["q_history"]
+        self._last_q = state["last_q"]
+        self._last_intent = state["last_intent"]
+        self._qud = tuple(state["qud"])
+        self.pending_Qs = state["pending_Qs"]
+        self.current_state = state["current_state"]
+        self.responses = (
+            ChunkCursor.from_state(self.search, state["responses"])
+            if state["responses"] is not None
+            else None
+        )
+        self.log = defaultdict(list, state["log"])
+        self._started = state.get("started", time.time())
+
+    def state_size(self) -> int:
+        """Rough number of bytes held in this agent's dialogue state."""
+        texts = self._q_history + self.pending_Qs
+        if self.responses is not None:
+            texts.append(json.dumps(self.responses.get_state()))
+        texts += [entry for entries in self.log.values() for entry in entries]
+        return sum(len(text) for text in texts) + len(str(self))
+
     def q_history(self):
         return self._q_history
 
@@ -138,26 +540,70 @@ class Agent:
     def pending_Qs(self):
         return self.pending_Qs
 
+    def classify(self, text):
+        """Sends text to the intent backend. Errors and timeouts are treated as the fallback intent."""
+        try:
+            return self._nlu.message(text)
+        except Exception as e:
+            print(f"Intent classification failed for {text!r}: {e!r}")
+            return empty_response(text)
+
     def answer(self, question):
-        # use dialogue state and QUD and QA to produce good answers.
+        """Answers the preprocessed question, recording timing and state changes in metrics."""
+        previous_state = self.current_state
+        self._turn_intent = None
+        start = time.perf_counter()
+        with metrics.timed("answer"):
+            answer = self._answer(question)
+        if self.current_state != previous_state:
+            metrics.STATE_TRANSITIONS.inc(from_state=previous_state, to_state=self.current_state)
+        self.write_log(
+            {
+                "event": "turn",
+                "question": question,
+                "intent": self._turn_intent,
+                "from_state": previous_state,
+                "to_state": self.current_state,
+                "seconds": time.perf_counter() - start,
+            }
+        )
+        return answer
 
-        # Send the preprocessed question to wit.ai
-        response = self._wit.message(question)
+    def _answer(self, question):
+        # use dialogue state and QUD and QA to produce good answers.
+        original_question = question
+
+        # If the question has anaphora, also classify it with our best guess at what it refers
+        # to, at the same time as the question itself. Skipped for plain yes/no replies, and when
+        # the async server already classified what's needed (asgi_app.py)
+        resolved_question = resolved = None
+        if self.anaphora_detection(question):
+            resolved_question = self.anaphora_resolution(question)
+            if not self.is_yes_no_reply(question) and not classified_ahead():
+                resolved = classify_in_background(self.classify, resolved_question)
+
+        # Send the preprocessed question to wit.ai.
+        response = self.classify(question)
+        original_response = response
+
+        # If the question is either a question or unknown intent, use the resolved one
+        if resolved_question is not None and self.may_need_resolution(response):
+            question = resolved_question
+            # Classified here if it was skipped, or hasn't started yet (cancel succeeds)
+            if resolved is None or resolved.cancel():
+                response = self.classify(question)
+            else:
+                response = resolved.result()
+        elif resolved is not None:
+            resolved.cancel()
 
         # Get the most likely intent.
         intent = Agent.get_most_likely_intent(response)
         intent_name = intent["name"]
         intent_confidence = intent["confidence"]
 
-        # If the question has anaphora and is either a question or unknown intent, add our best guess at anaphora resolution and reprocess the question
-        if (intent_name in (self.QUESTION_INTENT, self.FALLBACK_INTENT)) and (self.anaphora_detection(question)):
-            question = self.anaphora_resolution(question)
-            response = self._wit.message(question)
-
-            intent = Agent.get_most_likely_intent(response)
-            intent_name = intent["name"]
-            intent_confidence = intent["confidence"]
-
+        metrics.INTENTS.inc(intent=intent_name)
+        self._turn_intent = intent_name
         # log the question, storing based on intent
         self.log[intent_name].append(question)
 
@@ -181,8 +627,15 @@ class Agent:
 
         # if it's a yes and we're waiting on follow up for pending Qs --- OR --- if this is the first of many pending Qs
         if intent_name == self.YES_INTENT and self.current_state == self.PENDING_FOLLOW_UP or self.current_state == self.FIRST_OF_MULTI:
-            # run the relevant Q through wit
-            response = self._wit.message(self.pending_Qs[0])
+            # run the relevant Q through wit, unless that's what we just classified or it was prefetched
+            prefetched_results = None
+            prefetched = self.take_prefetched(self.pending_Qs[0])
+            if self.pending_Qs[0] == original_question:
+                response = original_response
+            elif prefetched is not None:
+                response, prefetched_results = prefetched
+            else:
+                response = self.classify(self.pending_Qs[0])
             intent = Agent.get_most_likely_intent(response)
             intent_name = intent["name"]
 
@@ -201,7 +654,7 @@ class Agent:
                 self.pending_Qs.pop(0)
             # if it's a regular old question, send to the QA procedure
             if intent_name == self.QUESTION_INTENT:
-                return self.first_question_response_attempt(response)
+                return self.first_question_response_attempt(response, prefetched_results)
             # if it's not a regular QA
             else:
                 # if it's grades and there are more to come
@@ -247,38 +700,42 @@ class Agent:
 
         return "Yes. " + question
 
-    def first_question_response_attempt(self, response):
-        """Student asked a question. Do a search for a relevant answer."""
-        entities: Optional[Dict] = response.get("entities", None)
-        self.responses.extend(self.lookup_reference_answer(entities))
+    def first_question_response_attempt(self, response, results=None):
+        """Student asked a question. Do a search for a relevant answer, unless results were already found."""
+        if results is None:
+            entities: Optional[Dict] = response.get("entities", None)
+            results = self.lookup_reference_answer(entities)
+        self.responses = results
+        result = self.next_result()
         if self.current_state == self.FIRST_OF_MULTI:
-            if self.responses:
+            if result is not None:
                 self.current_state = self.QA_FOLLOW_UP
-                return f"Your first question was \"" + self.pending_Qs.pop(0) + f"\"\n I found this in the course materials: \"\n {self.responses.pop(0)}\n\n\" Is that helpful?"
+                return f"Your first question was \"" + self.pending_Qs.pop(0) + "\"\n " + self.present_result(result)
             # if we couldn't return a chunk from the reference material, bail
             if len(self.pending_Qs) != 0:
                 self.current_state = self.PENDING_FOLLOW_UP
                 return "Sorry, I couldn't seem to find a good answer for your first question. Your next question was \"" + self.pending_Qs[0] + "\"\n Would you like me to talk about that?"
             return "Sorry, I couldn't seem to find a good answer for your first question."
         else:
-            if self.responses:
+            if result is not None:
                 self.current_state = self.QA_FOLLOW_UP
-                return f"I found this in the course materials: \"\n {self.responses.pop(0)}\n\n\" Is that helpful?"
+                return self.present_result(result)
             # if we couldn't return a chunk from the reference material, bail
             return "Sorry, I couldn't seem to find a good answer for your question."
 
     def qa_follow_up(self, intent_name):
         """
-        When in QA follow up state, tries to pop potential responses.
+        When in QA follow up state, tries the next chunk from the reference material.
         """
-        if intent_name == self.NO_INTENT and self.responses:
-            return f"I found this in the course materials: \"\n {self.responses.pop(0)}\n\n\" Is that helpful?"
-        elif intent_name == self.NO_INTENT and not self.responses:
+        result = self.next_result() if intent_name == self.NO_INTENT else None
+        if result is not None:
+            return self.present_result(result)
+        elif intent_name == self.NO_INTENT:
             self.current_state = self.NEUTRAL
 
             # Log that we failed to answere the question
             self.log[self.last_intent()][len(self.log[self.last_intent()]) - 1] = self.log[self.last_intent()
-                                                                                           ][len(self.log[self.last_intent()]) - 1] + "\t\t(I didn't answer this one)"
+                                                                                           ][len(self.log[self.last_intent()]) - 1] + UNANSWERED_NOTE
             # if there are pending Qs, prompt
             if len(self.pending_Qs) != 0:
                 self.current_state = self.PENDING_FOLLOW_UP
@@ -287,12 +744,12 @@ class Agent:
             return "Sorry I couldn't answer that. I'm still learning. What else can I do for you?"
         else:
             # Clear responses, since question answered
-            self.responses = []
+            self.responses = None
             self.current_state = self.NEUTRAL
 
             # Log that we believe we answered the question
             self.log[self.last_intent()][len(self.log[self.last_intent()]) - 1] = self.log[self.last_intent()
-                                                                                           ][len(self.log[self.last_intent()]) - 1] + "\t\t(I think I answered this one)"
+                                                                                           ][len(self.log[self.last_intent()]) - 1] + ANSWERED_NOTE
             # if there are pending Qs, prompt
             if len(self.pending_Qs) != 0:
                 self.current_state = self.PENDING_FOLLOW_UP
@@ -300,31 +757,66 @@ class Agent:
             self.current_state = self.NEUTRAL
             return "great, glad it helped!"
 
-    def lookup_reference_answer(self, entities: Optional[Dict]) -> Optional[List[str]]:
+    @staticmethod
+    def present_result(result: SearchResult) -> str:
+        """Offers a chunk from the reference material, citing where it came from."""
+        return f"I found this in {result.source}: \"\n {result.text}\n\n\" Is that helpful?"
+
+    def next_result(self) -> Optional[SearchResult]:
+        """The next chunk for the current question, or None if there are no more."""
+        return self.responses.next() if self.responses is not None else None
+
+    def lookup_reference_answer(self, entities: Optional[Dict]) -> Optional[ChunkCursor]:
         """
-        Grab the search_query entities identified by WIT for a question intent, and do
-        a lookup for chunks from the text.
+        Grab the search_query entities identified by WIT for a question intent, and start
+        a cursor over chunks from the reference material. Chunks are only looked up as
+        they're needed, so rejected answers can be followed by up to REFERENCE_DEPTH more.
         """
-        if entities is not None:
-            search_queries = entities.get("wit$search_query:search_query", [])
-            print("Search Query: ", search_queries)
-            # Not the best way to grab all the search terms, but maybe good enough
-            search_query = " ".join([d["value"] for d in search_queries])
-            if search_query:
-                # Use 3 tries to get useful info for now
-                return self.search.query_top_chunks(search_query, window_size=3, chunks=3)
+        search_query = self.search_query(entities)
+        if search_query:
+            return ChunkCursor(self.search, search_query, window_size=3, depth=REFERENCE_DEPTH)
         return None
 
+    @staticmethod
+    def search_query(entities: Optional[Dict]) -> str:
+        """The search terms WIT identified for a question intent, empty if there aren't any."""
+        if entities is None:
+            return ""
+        search_queries = entities.get("wit$search_query:search_query", [])
+        print("Search Query: ", search_queries)
+        # Not the best way to grab all the search terms, but maybe good enough
+        return " ".join([d["value"] for d in search_queries])
+
+    def write_log(self, record: Dict) -> None:
+        """Queues record for the conversation log, tagged with the session and time."""
+        if self._conversation_log is not None:
+            self._conversation_log.write({"time": time.time(), "session_id": self.session_id, **record})
+
     def log_conversation(self):
-        file = open("./conversation_summary.txt", "w+")
-        conversation = self.log.items()
-        for key, value in conversation:
-            if (key not in ("yes", "no", "exit", "fallback")):
-                file.write(key.upper() + ":\n")
-                for entry in value:
-                    file.write("\t" + entry + "\n")
-                file.write("\n")
-        file.close()
+        """Logs a summary of the conversation: what was asked, by intent, and whether we answered it."""
+        questions = []
+        for intent, entries in self.log.items():
+            if intent in ("yes", "no", "exit", "fallback"):
+                continue
+            for entry in entries:
+                text, answered = entry, None
+                if entry.endswith(ANSWERED_NOTE):
+                    text, answered = entry[: -len(ANSWERED_NOTE)], True
+                elif entry.endswith(UNANSWERED_NOTE):
+                    text, answered = entry[: -len(UNANSWERED_NOTE)], False
+                questions.append({"intent": intent, "text": text, "answered": answered})
+        self.write_log(
+            {
+                "event": "conversation",
+                "started": self._started,
+                "seconds": time.time() - self._started,
+                "turns": len(self._q_history),
+                "intents": {intent: len(entries) for intent, entries in self.log.items()},
+                "questions": questions,
+                "answered": sum(q["answered"] is True for q in questions),
+                "unanswered": sum(q["answered"] is False for q in questions),
+            }
+        )
 
     def get_new_qud(self, question, response):
         """Given the most recent question and the Wit.ai analysis of it, return the predicted new QUD."""
@@ -360,21 +852,166 @@ class Agent:
         return text + " " + self.qud()[1]
 
 
-try:
-    with open("atam_client_access_token.secret", encoding="utf8") as secret_file:
-        '''Please ensure'''
-        atam_client_access_token = secret_file.read()
-except:
-    print("ATAM Python service failed: Please include atam_client_access_token.secret in project root directory with Wit.AI client key")
-    exit(1)
+def cancel_prefetch(questions):
+    """Cancels the prefetches of questions that haven't started, and forgets all of them."""
+    for question in questions:
+        future = _prefetched.pop(normalize_query(question))
+        if future is not None:
+            future.cancel()
 
 
-agent = Agent(atam_client_access_token=atam_client_access_token)
+class _Session:
+    """
+    A SessionStore entry: the agent, its lock, when it was last used, and its state size and
+    pending questions after its last turn.
+    """
 
+    def __init__(self, agent):
+        self.agent = agent
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.size = 0
+        self.pending = []
 
-def preprocess(text, qud):
+
+class SessionStore:
     """
-    Preprocess text before sending to agent.
+    Keeps one Agent per session id. Sessions idle for longer than ttl seconds are evicted,
+    as are the least recently used sessions once all dialogue state passes max_bytes.
+    Each session's state size is measured at the end of its own turns, under its own lock,
+    and added to a running total, so eviction never looks at other sessions' agents.
+    """
+
+    def __init__(self, agent_factory, ttl: float = SESSION_TTL, max_bytes: int = SESSION_MEMORY_LIMIT):
+        self._agent_factory = agent_factory
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        # session id -> _Session, least recently used first
+        self._sessions = OrderedDict()
+        # Sum of the sizes of the sessions in _sessions
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @contextmanager
+    def session(self, session_id):
+        """Yields the session's agent, holding its lock so a session only runs one turn at a time."""
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is None:
+                agent = self._agent_factory()
+                agent.session_id = session_id
+                entry = _Session(agent)
+            entry.last_used = time.monotonic()
+            self._sessions[session_id] = entry
+            self._evict()
+        with entry.lock:
+            try:
+                yield entry.agent
+            finally:
+                size = entry.agent.state_size()
+                pending = list(entry.agent.pending_Qs)
+                with self._lock:
+                    # Evicted sessions were already taken off the total
+                    if self._sessions.get(session_id) is entry:
+                        self._total += size - entry.size
+                    entry.size = size
+                    entry.pending = pending
+
+    def _evict(self):
+        """
+        Drops sessions from the least recently used end while they're expired or all state
+        is over the memory limit, cancelling their prefetches. Never drops the session that is
+        about to be used, which is last.
+        """
+        now = time.monotonic()
+        while len(self._sessions) > 1:
+            oldest = next(iter(self._sessions.values()))
+            if now - oldest.last_used <= self._ttl and self._total <= self._max_bytes:
+                break
+            self._sessions.popitem(last=False)
+            self._total -= oldest.size
+            cancel_prefetch(oldest.pending)
+
+
+class FileSessionStore:
+    """
+    Keeps each session's dialogue state in a JSON file under directory, so every worker
+    process sees the same sessions. The file is locked for the whole turn, so a session
+    only runs one turn at a time across all workers. Sessions idle for longer than ttl
+    seconds are removed. Needs fcntl, so Unix only.
+    """
+
+    def __init__(self, directory: str, agent_factory, ttl: float = SESSION_TTL):
+        self._directory = directory
+        self._agent_factory = agent_factory
+        self._ttl = ttl
+        self._last_eviction = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return sum(1 for name in os.listdir(self._directory) if name.endswith(".json"))
+
+    def _path(self, session_id) -> str:
+        # Hash the id so clients can't pick the file name
+        name = hashlib.sha1(str(session_id).encode("utf8")).hexdigest()
+        return os.path.join(self._directory, name + ".json")
+
+    @contextmanager
+    def session(self, session_id):
+        """Yields an agent with the session's state, saving the state when the turn is done."""
+        import fcntl
+
+        with open(self._path(session_id), "a+", encoding="utf8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                saved = f.read()
+                agent = self._agent_factory()
+                agent.session_id = session_id
+                if saved:
+                    agent.set_state(json.loads(saved))
+                yield agent
+                f.seek(0)
+                f.truncate()
+                json.dump(agent.get_state(), f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self._evict()
+
+    @staticmethod
+    def _pending_questions(path):
+        """The pending questions saved in a session file, empty if it can't be read."""
+        try:
+            with open(path, "r", encoding="utf8") as f:
+                return json.load(f).get("pending_Qs", [])
+        except ValueError:
+            return []
+
+    def _evict(self):
+        """Removes expired sessions, checking at most once a minute, and cancels their prefetches."""
+        now = time.time()
+        if now - self._last_eviction < 60:
+            return
+        self._last_eviction = now
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            try:
+                if now - os.path.getmtime(path) > self._ttl:
+                    cancel_prefetch(self._pending_questions(path))
+                    os.remove(path)
+            except FileNotFoundError:
+                # Another worker removed it first
+                pass
+
+
+def split_questions(text):
+    """
+    Strips extra punctuation from text and splits it into questions on '?'.
+    Returns an empty list if there's nothing left.
     """
     text = text.strip()
 
@@ -388,24 +1025,88 @@ def preprocess(text, qud):
         if text[-1] == '?':
             text = text[:-1]
         # split input on ?
-        questions = text.split('?')
-        # if there is more than one question, add all to pending Qs
-        if len(questions) > 1:
-            for q in questions:
-                q = q.strip()
-                agent.pending_Qs.append(q)
-            agent.current_state = agent.FIRST_OF_MULTI
-
-            return agent.pending_Qs[0]
-        else:
-            return text
-    else:
+        return [q.strip() for q in text.split('?')]
+    return []
+
+
+def preprocess(text, agent):
+    """
+    Preprocess text before sending to agent.
+    """
+    questions = split_questions(text)
+    if not questions:
         return "!"
+    # if there is more than one question, add all to pending Qs
+    if len(questions) > 1:
+        agent.pending_Qs.extend(questions)
+        agent.current_state = agent.FIRST_OF_MULTI
+        # The first question is answered now, get a head start on the rest
+        agent.prefetch(agent.pending_Qs[1:])
+
+        return agent.pending_Qs[0]
+    return questions[0]
+
+
+def turn_texts(text, agent):
+    """
+    The texts answering text will classify, as far as they can be known before the turn:
+    its questions and the pending question a "yes" would bring up. Also returns the first
+    question with its anaphora resolved, or None if it has none. That one is only classified
+    if the first question's classification needs it (see Agent.may_need_resolution).
+    """
+    questions = split_questions(text) or ["!"]
+    texts = list(questions)
+    if agent.pending_Qs:
+        texts.append(agent.pending_Qs[0])
+    resolved = None
+    if agent.anaphora_detection(questions[0]):
+        resolved = agent.anaphora_resolution(questions[0])
+    return texts, resolved
 
 
-def get_answer(question):
+def answer_batch(questions, agent):
+    """
+    Answers several questions in one go, outside of any conversation. The questions are
+    classified at the same time, and all the search queries are encoded in one batch and
+    searched together. Returns a result per question: its intent, an answer, and for
+    questions the passages found in the reference material.
+    """
+    responses = classify_concurrently(agent.classify, questions)
+    intents = [Agent.get_most_likely_intent(response)["name"] for response in responses]
+    search_queries = {
+        i: Agent.search_query(response.get("entities"))
+        for i, (intent, response) in enumerate(zip(intents, responses))
+        if intent == Agent.QUESTION_INTENT
+    }
+    search_queries = {i: query for i, query in search_queries.items() if query}
+    found = agent.search.query_top_chunk_results_batch(
+        list(search_queries.values()), window_size=3, chunks=3
+    )
+    passages = dict(zip(search_queries, found))
+
+    results = []
+    for i, (question, intent) in enumerate(zip(questions, intents)):
+        result = {"question": question, "intent": intent, "passages": []}
+        if intent == Agent.QUESTION_INTENT:
+            result["passages"] = [
+                {"text": r.text, "source": r.source, "distance": r.distance}
+                for r in passages.get(i, [])
+            ]
+            if result["passages"]:
+                result["answer"] = Agent.present_result(passages[i][0])
+            else:
+                result["answer"] = "Sorry, I couldn't seem to find a good answer for your question."
+        elif intent in agent._hardcoded_responses:
+            result["answer"] = random.choice(agent._hardcoded_responses[intent])
+        else:
+            result["answer"] = random.choice(agent._hardcoded_responses[Agent.FALLBACK_INTENT])
+        results.append(result)
+    return results
+
+
+def get_answer(question, agent):
     """Return an answer, given a question. Preprocess question and update state as necessary."""
-    preprocessed_question = preprocess(question, agent.qud())
+    preprocessed_question = preprocess(question, agent)
     # Update state.
     agent.add_to_history(preprocessed_question)
 
@@ -415,22 +1116,252 @@ def get_answer(question):
     return answer
 
 
-@app.route("/ask", methods=["POST"])
+@routes.before_app_request
+def start_request_timer():
+    """Times every request. Sending an X-ATAM-Trace header also traces its stages."""
+    g.start_time = time.perf_counter()
+    g.trace = metrics.start_trace() if request.headers.get("X-ATAM-Trace") else None
+
+
+@routes.after_app_request
+def record_request(response):
+    elapsed = time.perf_counter() - g.start_time
+    endpoint = request.endpoint or "unknown"
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+    metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if g.trace is not None:
+        # Stage times in milliseconds, in the order they finished
+        stages = [{"stage": stage, "ms": round(seconds * 1000, 3)} for stage, seconds in g.trace]
+        response.headers["X-ATAM-Trace"] = json.dumps(
+            {"total_ms": round(elapsed * 1000, 3), "stages": stages}
+        )
+        metrics.end_trace()
+    return response
+
+
+@routes.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Metrics in Prometheus text format."""
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+@routes.route("/healthz", methods=["GET"])
+def healthz():
+    """The process is up and serving, whether or not it has finished loading."""
+    return "ok"
+
+
+@routes.route("/readyz", methods=["GET"])
+def readyz():
+    """200 once the model and index are loaded and questions can be answered, 503 until then."""
+    loader = current_app.extensions["atam"]["loader"]
+    if loader is None or loader.ready.is_set():
+        return jsonify({"ready": True})
+    return jsonify({"ready": False, "error": loader.error}), 503
+
+
+def not_ready_response():
+    response = make_response(NOT_READY_ANSWER, 503)
+    response.headers["Retry-After"] = "5"
+    return response
+
+
+@routes.route("/ask", methods=["POST"])
 def ask():
-    """Expects a posted JSON object with a field called 'question' that contains user's question."""
+    """
+    Expects a posted JSON object with a field called 'question' that contains user's question,
+    and optionally a 'session_id' field identifying the conversation.
+    The session's dialogue state after the turn is sent back in the X-Dialogue-State header.
+    """
     data = request.get_json()
     question = data.get("question")
     if not question:
         return "Error: Bad JSON. Needs question field."
-
-    answer = get_answer(question)
-    return answer
-
-
-def main(debug=False, port=5000):
-    """Runs web app on specified port. If debug is true, the server will restart whenever the file is saved."""
-    app.run(debug=debug, port=port)
+    loader = current_app.extensions["atam"]["loader"]
+    if loader is not None and not loader.can_answer(question):
+        return not_ready_response()
+    session_id = data.get("session_id") or uuid.uuid4().hex
+
+    sessions = current_app.extensions["atam"]["sessions"]
+    with sessions.session(session_id) as agent:
+        answer = get_answer(question, agent)
+        state = agent.current_state
+    response = make_response(answer)
+    response.headers["X-Session-Id"] = session_id
+    response.headers["X-Dialogue-State"] = state
+    return response
+
+
+@routes.route("/ask_batch", methods=["POST"])
+def ask_batch():
+    """
+    Answers a list of questions in one request. Expects a posted JSON object with either a
+    'questions' list, or a 'question' string holding several questions separated by '?'.
+    Responds with {"results": [...]}, one result per question (see answer_batch).
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    questions = data.get("questions")
+    if questions is None and isinstance(data.get("question"), str):
+        questions = split_questions(data["question"])
+    if not isinstance(questions, list) or not questions or not all(isinstance(q, str) for q in questions):
+        return "Error: Bad JSON. Needs a questions list or question field.", 400
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        return f"Error: At most {MAX_BATCH_QUESTIONS} questions per batch.", 400
+    loader = current_app.extensions["atam"]["loader"]
+    if loader is not None and not loader.ready.is_set():
+        return not_ready_response()
+
+    # A throwaway agent, batch questions aren't part of a conversation
+    agent = current_app.extensions["atam"]["agent_factory"]()
+    return jsonify({"results": answer_batch(questions, agent)})
+
+
+def create_app(
+    search=None,
+    nlu=None,
+    session_dir=None,
+    debug=True,
+    conversation_log_path=CONVERSATION_LOG_PATH,
+    lazy=False,
+    prefill_intents=False,
+    warm=True,
+) -> Flask:
+    """
+    Builds the web app. The model, index and intent backend are loaded once here and shared
+    by all sessions; pass search or nlu to use ones that are already loaded. Sessions are
+    kept in memory, or in session_dir when the app is served by several worker processes.
+    If debug is true, agents print their state every turn. Conversations are logged to
+    conversation_log_path, unless it's None.
+    If lazy is true, the app is returned at once and loading happens in the background
+    (see BackgroundLoader). prefill_intents wraps the agents' intent backend in a
+    PrefilledIntentBackend, for asgi_app.py. With warm false, the eagerly loaded search
+    isn't warmed up, for apps that are forked before serving (see serve).
+    """
+    loader = None
+    if lazy:
+        loader = BackgroundLoader(search, nlu)
+        search, nlu = loader.search, loader
+        loader.start()
+    else:
+        if search is None:
+            search = load_search()
+        if nlu is None:
+            nlu = load_intent_backend(search.model)
+        if warm:
+            warm_up(search)
+    if prefill_intents:
+        nlu = PrefilledIntentBackend(nlu, INTENT_CACHE_SIZE)
+    hardcoded_responses = load_hardcoded_responses()
+    conversation_log = None
+    if conversation_log_path is not None:
+        conversation_log = ConversationLog(conversation_log_path)
+        atexit.register(conversation_log.close)
+
+    def agent_factory():
+        return Agent(nlu, search, hardcoded_responses, debug=debug, conversation_log=conversation_log)
+
+    if session_dir is None:
+        sessions = SessionStore(agent_factory)
+    else:
+        sessions = FileSessionStore(session_dir, agent_factory)
+    metrics.REGISTRY.gauge("atam_sessions", "Open dialogue sessions", callback=lambda: len(sessions))
+
+    app = Flask(__name__)
+    CORS(app, expose_headers=["X-Session-Id", "X-Dialogue-State", "X-ATAM-Trace"])
+    app.register_blueprint(routes)
+    app.extensions["atam"] = {
+        "search": search,
+        "nlu": nlu,
+        "sessions": sessions,
+        "agent_factory": agent_factory,
+        "conversation_log": conversation_log,
+        "loader": loader,
+    }
+    return app
+
+
+def serve(port=5000, workers=2, threads=4, lazy=False):
+    """
+    Production server. Loads the model and index once in the master process, then forks
+    workers that share those pages copy-on-write instead of each loading their own copy.
+    Sessions are kept in SESSION_DIR so any worker can continue any conversation.
+    If lazy is true, workers start serving at once and each loads its own copy in the
+    background instead, trading memory for startup time.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    import torch
+
+    app = None
+    if not lazy:
+        # torch's OpenMP thread pool doesn't survive a fork, and workers that inherit one can
+        # hang on their first encode. So the master never starts it: it runs the model on one
+        # thread if it has to build a shard, and leaves the warm-up to each worker.
+        torch.set_num_threads(1)
+        app = create_app(session_dir=SESSION_DIR, debug=False, warm=False)
+        # Keep the garbage collector from touching (and so copying) the preloaded objects in workers
+        gc.freeze()
+
+    def post_fork(server, worker):
+        # Split the CPU cores between the workers instead of every worker using all of them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+        if app is not None:
+            warm_up(app.extensions["atam"]["search"])
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"0.0.0.0:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("preload_app", not lazy)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            # Lazy apps are built in each worker, so their loading threads run after the fork
+            return app if app is not None else create_app(session_dir=SESSION_DIR, debug=False, lazy=True)
+
+    Server().run()
+
+
+def main(debug=False, port=5000, workers=1, lazy=False):
+    """
+    Runs web app on specified port. With more than one worker, serves it with gunicorn (see serve).
+    Otherwise uses Flask's server, handling requests on multiple threads.
+    If debug is true, Flask runs in debug mode and agents print their state every turn.
+    The reloader is off so the model isn't loaded twice.
+    If lazy is true, the port is bound before the model and index are loaded.
+    """
+    if workers > 1:
+        serve(port, workers, lazy=lazy)
+        return
+    app = create_app(debug=debug, lazy=lazy)
+    app.run(debug=debug, port=port, threaded=True, use_reloader=False)
 
 
 if __name__ == "__main__":
-    main(debug=True, port=5000)
+    parser = ArgumentParser()
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes. More than one serves with gunicorn, sharing the model between them.",
+    )
+    parser.add_argument("--quiet", action="store_true", help="Turn off debug mode")
+    parser.add_argument(
+        "--lazy",
+        action="store_true",
+        help="Start serving at once and load the model and index in the background",
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="Save a warm start snapshot of the model and build the index, then exit",
+    )
+    args = parser.parse_args()
+    if args.snapshot:
+        save_warm_start()
+    else:
+        main(debug=not args.quiet, port=args.port, workers=args.workers, lazy=args.lazy)
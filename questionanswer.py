@@ -5,90 +5,1220 @@ Sentence similarity search using annoy.
 To use preprocess, you need spacy.
 python -m spacy download en_core_web_sm
 """
+import hashlib
+import heapq
 import json
+import mmap
 import os
+import queue
+import threading
+import time
 from argparse import ArgumentParser
-from typing import List
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
 
-from annoy import AnnoyIndex
-from sentence_transformers import SentenceTransformer
+import numpy as np
 import spacy
 
+import backends
+import encoders
+import metrics
+from clean_textbook import Cleaner, expand_sources
+from compression import EmbeddingCompressor
+from encoders import DEFAULT_ENCODER
+from keyword_index import KeywordIndex, fuse_results, is_keyword_query
 
-class SimilaritySearch:
+# Bump when the files written by SimilaritySearch.save change, so old indexes get rebuilt
+INDEX_FORMAT_VERSION = 4
+# Search parameters chosen by tune_index.py, kept in the index directory
+TUNING_FILE = "tuning.json"
+
+
+def normalize_query(query: str) -> str:
+    """Lowercases and collapses whitespace so trivially different queries share cache entries."""
+    return " ".join(query.lower().split())
+
+
+class LRUCache:
+    """
+    Thread-safe cache that holds at most maxsize entries, dropping the least recently
+    used entry when full. Counts hits and misses, and reports them to metrics under name.
+    """
+
+    def __init__(self, maxsize: int = 1024, name: str = "cache"):
+        self.maxsize = maxsize
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                value = self._data[key]
+            else:
+                self.misses += 1
+                value = default
+        metrics.CACHE_REQUESTS.inc(cache=self.name, result="miss" if value is default else "hit")
+        return value
+
+    def __contains__(self, key) -> bool:
+        """Whether key is cached, without counting a hit or miss or making it recently used."""
+        with self._lock:
+            return key in self._data
+
+    def pop(self, key, default=None):
+        """Removes key and returns its value, without counting a hit or miss."""
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class SentenceStore:
+    """
+    Sentences stored as one UTF-8 blob, each followed by a space, plus an array of the
+    byte offset where each sentence starts. A window of neighbouring sentences is then a
+    single slice of the blob. Loaded stores are memory mapped like the Annoy index, so
+    every process serving the same index shares the pages.
+    """
+
+    def __init__(self, blob=b"", offsets=None):
+        self._blob = blob
+        self._offsets = np.zeros(1, dtype=np.int64) if offsets is None else offsets
+
+    @classmethod
+    def from_sentences(cls, sentences: List[str]) -> "SentenceStore":
+        encoded = [sent.encode("utf8") + b" " for sent in sentences]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(sent) for sent in encoded], out=offsets[1:])
+        return cls(b"".join(encoded), offsets)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.window(i, i + 1)
+
+    def window(self, start: int, end: int) -> str:
+        """
+        Sentences start to end (exclusive) joined by spaces. The window is clamped to the
+        start and end of the store.
+        """
+        start = max(start, 0)
+        end = min(end, len(self))
+        if end <= start:
+            return ""
+        # Leave off the space after the last sentence
+        text = self._blob[int(self._offsets[start]) : int(self._offsets[end]) - 1]
+        return text.decode("utf8")
+
+    def save(self, path: str) -> None:
+        # Loaded stores memory map both files, so they are replaced rather than overwritten
+        backends.replace_file(os.path.join(path, "sentences.bin"), lambda f: f.write(self._blob))
+        backends.replace_file(
+            os.path.join(path, "sentences.offsets.npy"), lambda f: np.save(f, self._offsets)
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "SentenceStore":
+        offsets = np.load(os.path.join(path, "sentences.offsets.npy"), mmap_mode="r")
+        blob = b""
+        with open(os.path.join(path, "sentences.bin"), "rb") as f:
+            # Can't memory map an empty file
+            if os.fstat(f.fileno()).st_size:
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(blob, offsets)
+
+
+class SearchResult(NamedTuple):
+    """
+    A matched sentence or chunk, where it came from and how far it was from the query.
+    Results found by keyword get their negated BM25 or fusion score as distance, so lower
+    is always better.
+    """
+
+    text: str
+    source: str
+    distance: float
+    # Id of the matched sentence in its source's index
+    index: int
+
+
+class QueryEncoder:
+    """
+    Encodes queries with the model, caching embeddings by normalized query text. The model
+    always gets the query as it was asked, since cased encoders embed "HMM" and "hmm" differently.
+    """
+
+    def __init__(self, model, cache_size: int = 1024):
+        self.model = model
+        self.cache = LRUCache(cache_size, "query_embeddings")
+
+    def encode(self, query: str):
+        key = normalize_query(query)
+        embedding = self.cache.get(key)
+        if embedding is None:
+            with metrics.timed("encode"):
+                embedding = self.model.encode(query)
+            self.cache.put(key, embedding)
+        return embedding
+
+    def encode_batch(self, queries: List[str]) -> List:
+        """Encodes queries, sending all the ones that aren't cached to the model in one batch."""
+        keys = [normalize_query(query) for query in queries]
+        embeddings = {key: self.cache.get(key) for key in keys}
+        # The first query asked for each missing key
+        missing = {}
+        for key, query in zip(keys, queries):
+            if embeddings[key] is None:
+                missing.setdefault(key, query)
+        if missing:
+            with metrics.timed("encode"):
+                encoded = self.model.encode(list(missing.values()))
+            for key, embedding in zip(missing, encoded):
+                self.cache.put(key, embedding)
+                embeddings[key] = embedding
+        return [embeddings[key] for key in keys]
+
+
+class _BatchedQuery(NamedTuple):
+    query: str
+    n: int
+    window_size: Optional[int]
+    future: Future
+    queued: float
+
+
+class QueryBatcher:
+    """
+    Gathers the queries that concurrent requests send to the embedding search and handles them
+    together on one thread: one batched encode, then one batched nearest (or nearest_chunks)
+    lookup per (n, window_size). Encoding on CPU costs much less per query in a batch.
+    A batch starts window seconds after its first query arrives, or as soon as it has
+    max_batch queries. With window 0, queries that arrive while a batch runs form the next one.
+    Each caller waits on a future for its own results. Queries whose embedding is already
+    cached don't come through here, they are searched on the caller's thread.
+    """
+
+    def __init__(self, search: "CachedQueries", window: float = 0.002, max_batch: int = 32):
+        self.search = search
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _start(self) -> None:
+        """
+        Starts the batching thread. Threads don't survive a fork, so a pre-forked worker
+        starts its own the first time it searches.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, name="query-batcher", daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, query: str, n: int, window_size: Optional[int] = None) -> Future:
+        """
+        Queues query to be searched for its n nearest sentences, or chunks if window_size
+        is given. The future's result is what nearest or nearest_chunks would return.
+        """
+        if self._pid != os.getpid():
+            self._start()
+        future = Future()
+        self._queue.put(_BatchedQuery(query, n, window_size, future, time.perf_counter()))
+        return future
+
+    def results(self, query: str, n: int, window_size: Optional[int] = None) -> List[SearchResult]:
+        """Submits query and waits for its results."""
+        with metrics.timed("batched_search"):
+            return self.submit(query, n, window_size).result()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = batch[0].queued + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.perf_counter(), 0)))
+                except queue.Empty:
+                    break
+            self._handle(batch)
+
+    def _handle(self, batch: List[_BatchedQuery]) -> None:
+        start = time.perf_counter()
+        metrics.ENCODE_BATCH_SIZE.observe(len(batch))
+        for request in batch:
+            metrics.ENCODE_QUEUE_SECONDS.observe(start - request.queued)
+        try:
+            embeddings = self.search.encoder.encode_batch([request.query for request in batch])
+            groups = defaultdict(list)
+            for request, embedding in zip(batch, embeddings):
+                groups[request.n, request.window_size].append((request, embedding))
+            for (n, window_size), group in groups.items():
+                vectors = [embedding for _, embedding in group]
+                if window_size is None:
+                    found = self.search.nearest_batch(vectors, n)
+                else:
+                    found = self.search.nearest_chunks_batch(vectors, window_size, n)
+                for (request, _), results in zip(group, found):
+                    request.future.set_result(results)
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+
+
+class CachedQueries:
+    """
+    Query methods shared by SimilaritySearch and ShardedSearch. Subclasses provide an
+    encoder, a result_cache, nearest/nearest_chunks to search by embedding and
+    keyword_results to search the keyword index.
+    Queries of a term or two with at least n matches in the keyword index are answered from
+    it without encoding them. Other queries are searched by embedding, and any keyword matches are
+    fused in with reciprocal rank fusion.
+    """
+
+    encoder: QueryEncoder
+    result_cache: LRUCache
+    # Sends embedding searches through a QueryBatcher when set
+    batcher: Optional[QueryBatcher] = None
+
+    def nearest(self, embedding, n: int) -> List[SearchResult]:
+        raise NotImplementedError
+
+    def nearest_batch(self, embeddings: List, n: int) -> List[List[SearchResult]]:
+        return [self.nearest(embedding, n) for embedding in embeddings]
+
+    def nearest_chunks(self, embedding, window_size: int, chunks: int) -> List[SearchResult]:
+        raise NotImplementedError
+
+    def nearest_chunks_batch(
+        self, embeddings: List, window_size: int, chunks: int
+    ) -> List[List[SearchResult]]:
+        return [self.nearest_chunks(embedding, window_size, chunks) for embedding in embeddings]
+
+    def chunk(self, result: SearchResult, window_size: int) -> SearchResult:
+        """result with its text widened to the window_size sentences either side of it."""
+        raise NotImplementedError
+
+    def keyword_results(self, query: str, n: int) -> List[SearchResult]:
+        """The n sentences best matching query's terms, or [] if there's no keyword index."""
+        raise NotImplementedError
+
+    def _keyword_route(
+        self, query: str, n: int, window_size: Optional[int] = None
+    ) -> Optional[List[SearchResult]]:
+        """
+        Keyword results for query, widened to chunks if window_size is given, when it can be
+        answered without the encoder. Otherwise None. Terms with fewer than n matches are
+        left to hybrid search, so there are still n results to offer.
+        """
+        if not is_keyword_query(query):
+            return None
+        keyword = self.keyword_results(query, n)
+        if len(keyword) < n:
+            return None
+        metrics.SEARCH_ROUTES.inc(route="keyword")
+        if window_size is None:
+            return keyword
+        return [self.chunk(result, window_size) for result in keyword]
+
+    def _fuse(
+        self, query: str, results: List[SearchResult], n: int, window_size: Optional[int] = None
+    ) -> List[SearchResult]:
+        """Fuses embedding search results with query's keyword matches, if it has any."""
+        keyword = self.keyword_results(query, n)
+        if not keyword:
+            metrics.SEARCH_ROUTES.inc(route="embedding")
+            return results
+        metrics.SEARCH_ROUTES.inc(route="hybrid")
+        fused = fuse_results(results, keyword, n=n)
+        if window_size is None:
+            return fused
+        # Results only found by keyword are still single sentences
+        widened = {(result.source, result.index) for result in results}
+        return [
+            result if (result.source, result.index) in widened else self.chunk(result, window_size)
+            for result in fused
+        ]
+
+    def clear_cache(self) -> None:
+        """
+        Drops cached results. Called whenever the index changes. Cached embeddings only
+        depend on the model, so they stay valid.
+        """
+        self.result_cache.clear()
+
+    def cache_stats(self):
+        return {
+            "embeddings": self.encoder.cache.stats(),
+            "results": self.result_cache.stats(),
+        }
+
+    def encode_query(self, query: str):
+        return self.encoder.encode(query)
+
+    def _embedding_results(
+        self, query: str, n: int, window_size: Optional[int] = None
+    ) -> List[SearchResult]:
+        """
+        nearest, or nearest_chunks if window_size is given, for query's embedding. Only queries
+        that need encoding go through the batcher, cached embeddings are searched right away.
+        """
+        if self.batcher is not None and normalize_query(query) not in self.encoder.cache:
+            return self.batcher.results(query, n, window_size)
+        embedding = self.encode_query(query)
+        if window_size is None:
+            return self.nearest(embedding, n)
+        return self.nearest_chunks(embedding, window_size, n)
+
+    def query_results(self, query: str, n: int = 10) -> List[SearchResult]:
+        key = (normalize_query(query), n, None)
+        result = self.result_cache.get(key)
+        if result is None:
+            result = self._keyword_route(query, n)
+            if result is None:
+                result = self._fuse(query, self._embedding_results(query, n), n)
+            self.result_cache.put(key, result)
+        # Copy so callers can't change what's cached
+        return list(result)
+
+    def query(self, query: str, n: int = 10) -> List[str]:
+        return [result.text for result in self.query_results(query, n)]
+
+    def query_top_chunk_results(
+        self, query: str, window_size: int = 10, chunks: int = 1
+    ) -> List[SearchResult]:
+        """
+        Queries for top n similar sentences then gets all the sentences in the window
+        to build chunks of text to return. Useful if you want broader context for the matched
+        sentence. Windows are cut short at the start and end of the text.
+        """
+        key = (normalize_query(query), chunks, window_size)
+        result = self.result_cache.get(key)
+        if result is None:
+            result = self._keyword_route(query, chunks, window_size)
+            if result is None:
+                result = self._fuse(
+                    query, self._embedding_results(query, chunks, window_size), chunks, window_size
+                )
+            self.result_cache.put(key, result)
+        return list(result)
+
+    def query_top_chunks(
+        self, query: str, window_size: int = 10, chunks: int = 1
+    ) -> List[str]:
+        return [
+            result.text
+            for result in self.query_top_chunk_results(query, window_size, chunks)
+        ]
+
+    def query_top_chunk_results_batch(
+        self, queries: List[str], window_size: int = 10, chunks: int = 1
+    ) -> List[List[SearchResult]]:
+        """
+        query_top_chunk_results for several queries at once. Uncached queries that need the
+        encoder are encoded in one batch and searched together.
+        """
+        keys = [(normalize_query(query), chunks, window_size) for query in queries]
+        results = {key: self.result_cache.get(key) for key in keys}
+        uncached = [key for key, result in results.items() if result is None]
+        for key in uncached:
+            results[key] = self._keyword_route(key[0], chunks, window_size)
+        missing = [key for key in uncached if results[key] is None]
+        if missing:
+            embeddings = self.encoder.encode_batch([key[0] for key in missing])
+            for key, result in zip(
+                missing, self.nearest_chunks_batch(embeddings, window_size, chunks)
+            ):
+                results[key] = self._fuse(key[0], result, chunks, window_size)
+        for key in uncached:
+            self.result_cache.put(key, results[key])
+        return [list(results[key]) for key in keys]
+
+
+class ChunkCursor:
+    """
+    Walks the chunks around the sentences nearest to a query, best first, assembling each
+    chunk only when it's asked for. The depth nearest sentences are looked up once, the first
+    time they're needed, and the ranking is kept so later chunks follow the same order.
+    A neighbour whose window overlaps a chunk already given is skipped. The cursor holds only
+    plain data (see get_state), so it can be saved with a session and picked up again on a
+    later turn.
+    """
+
+    def __init__(
+        self,
+        search: CachedQueries,
+        query: str,
+        window_size: int = 3,
+        depth: int = 10,
+        position: int = 0,
+        shown: Optional[List] = None,
+        neighbours: Optional[List] = None,
+    ):
+        self.search = search
+        self.query = query
+        self.window_size = window_size
+        self.depth = depth
+        # Number of neighbours looked at so far
+        self.position = position
+        # [source, index] of the neighbour behind every chunk given so far
+        self.shown = shown if shown is not None else []
+        # [source, index, distance] of the depth nearest sentences, best first, once looked up
+        self.neighbours = neighbours
+
+    def get_state(self) -> Dict:
+        return {
+            "query": self.query,
+            "window_size": self.window_size,
+            "depth": self.depth,
+            "position": self.position,
+            "shown": self.shown,
+            "neighbours": self.neighbours,
+        }
+
+    @classmethod
+    def from_state(cls, search: CachedQueries, state: Dict) -> "ChunkCursor":
+        return cls(search, **state)
+
+    def _ranked(self) -> List[List]:
+        """The neighbours, looked up in a single search so positions always refer to one ranking."""
+        if self.neighbours is None:
+            self.neighbours = [
+                [result.source, result.index, result.distance]
+                for result in self.search.query_results(self.query, self.depth)
+            ]
+        return self.neighbours
+
+    def _overlaps(self, source: str, index: int) -> bool:
+        return any(
+            shown_source == source and abs(shown_index - index) <= 2 * self.window_size
+            for shown_source, shown_index in self.shown
+        )
+
+    def _find(self):
+        """The position after the next neighbour to give a chunk for, and that neighbour."""
+        neighbours = self._ranked()
+        position = self.position
+        while position < len(neighbours):
+            neighbour = neighbours[position]
+            position += 1
+            if not self._overlaps(neighbour[0], neighbour[1]):
+                return position, neighbour
+        return position, None
+
+    def prefetch(self) -> None:
+        """Looks up the neighbours, so next() doesn't wait on the search."""
+        self._ranked()
+
+    def next(self) -> Optional[SearchResult]:
+        """The next chunk, or None when there are no more within depth."""
+        self.position, neighbour = self._find()
+        if neighbour is None:
+            return None
+        source, index, distance = neighbour
+        self.shown.append([source, index])
+        with metrics.timed("chunks"):
+            return self.search.chunk(SearchResult("", source, distance, index), self.window_size)
+
+
+class SimilaritySearch(CachedQueries):
     """
     Sentence embedding similarity search using Annoy and sentence embeddings.
     I've been using some of huggingface's sentence embeddings, but
     could adapt to use other embeddings.
+    Query embeddings and query results are kept in LRU caches of cache_size entries.
+    Results are labelled with source.
+    compression holds EmbeddingCompressor settings (normalize, pca_dim, quantize) to shrink
+    the embeddings that go in the index.
+    backend is "annoy" or "exact" (see backends.py). search_k is passed on to Annoy's
+    get_nns_by_vector, where -1 means its default of n * trees.
+    A BM25 keyword index (see keyword_index.py) is built over the same sentences.
     """
 
-    def __init__(self, model, embedding_size=768):
-        self.index = AnnoyIndex(embedding_size, "euclidean")
-        self.idx_to_sentence = {}
+    def __init__(
+        self,
+        model,
+        embedding_size=768,
+        cache_size=1024,
+        source: str = "",
+        encoder: Optional[QueryEncoder] = None,
+        compression: Optional[Dict] = None,
+        backend: str = "annoy",
+        search_k: int = -1,
+    ):
+        self.embedding_size = embedding_size
+        self.compressor = EmbeddingCompressor(**compression) if compression else None
+        self.search_k = search_k
+        self.use_backend(backend)
+        self.sentences = SentenceStore()
+        self.keywords: Optional[KeywordIndex] = None
         self.model = model
+        self.source = source
+        # normalized query -> embedding, can be shared with other searches using the same model
+        self.encoder = encoder if encoder is not None else QueryEncoder(model, cache_size)
+        # (normalized query, n, window_size) -> results
+        self.result_cache = LRUCache(cache_size, "query_results")
+
+    def use_backend(self, backend: str) -> None:
+        """Replaces the index with an empty one of the given backend."""
+        size, metric = self.embedding_size, "euclidean"
+        if self.compressor is not None:
+            size, metric = self.compressor.index_size(size), self.compressor.metric
+        self.index = backends.new_index(backend, size, metric)
+        self.backend = backend
+
+    @property
+    def index_file(self) -> str:
+        return backends.INDEX_FILES[self.backend]
 
-    def build_annoy_index(self, sentences: List[str], trees: int = 10):
-        print(f"Building index for {len(sentences)} sentences")
-        for i, sent in enumerate(sentences):
-            if i % 100 == 0:
-                print(f"{i} sentences complete")
-            if len(sent.split()) > 4:
-                self.index.add_item(i, self.model.encode(sent))
-            self.idx_to_sentence[i] = sent
+    def build_annoy_index(
+        self,
+        sentences: Iterable[str],
+        trees: int = 10,
+        batch_size: int = 64,
+        processes: int = 1,
+        embedding_cache: Optional["EmbeddingCache"] = None,
+    ):
+        """
+        Embeds the sentences and builds the index. Sentences are encoded batch_size at a
+        time, and if processes > 1 the batches are spread over a pool of CPU worker processes.
+        sentences can be a generator such as Preprocessor.iter_sentences, in which case
+        encoding starts while the text is still being split.
+        Sentences already in embedding_cache aren't encoded again, and new embeddings are added to it.
+        Short sentences (4 words or fewer) aren't indexed, but keep their ids so they
+        still show up in chunk windows.
+        With compression, embeddings are collected until all sentences are encoded, since
+        the PCA projection is fitted to all of them before anything is added to the index.
+        """
+        print("Building index")
+        all_sentences = []
+        # Embeddings waiting for compression, and their ids
+        collected_ids, collected = [], []
+        if self.compressor is None:
+            add = self.index.add_item
+        else:
+
+            def add(i, embedding):
+                collected_ids.append(i)
+                collected.append(embedding)
+
+        # Ids of sentences waiting to be encoded
+        pending = []
+        pool = None
+        encoded = reused = 0
+        # Hand each call enough sentences to keep every worker busy
+        step = batch_size * max(processes, 1)
+        start = time.perf_counter()
+        try:
+            for i, sent in enumerate(sentences):
+                all_sentences.append(sent)
+                if len(sent.split()) <= 4:
+                    continue
+                if embedding_cache is not None:
+                    embedding = embedding_cache.get(sent)
+                    if embedding is not None:
+                        add(i, embedding)
+                        reused += 1
+                        continue
+                pending.append(i)
+                if len(pending) < step:
+                    continue
+                if pool is None and processes > 1:
+                    pool = self.model.start_multi_process_pool(["cpu"] * processes)
+                encoded += self._add_batch(
+                    all_sentences, pending, batch_size, pool, embedding_cache, add
+                )
+                pending = []
+                rate = encoded / (time.perf_counter() - start)
+                print(f"{encoded} sentences encoded ({rate:.1f} sentences/sec)")
+            if pending:
+                encoded += self._add_batch(
+                    all_sentences, pending, batch_size, pool, embedding_cache, add
+                )
+        finally:
+            if pool is not None:
+                self.model.stop_multi_process_pool(pool)
+        print(
+            f"Indexed {len(all_sentences)} sentences, {encoded} encoded and "
+            f"{reused} reused from the cache in {time.perf_counter() - start:.1f}s"
+        )
+        self.sentences = SentenceStore.from_sentences(all_sentences)
+        # Keyword search covers the same sentences as the embedding index
+        self.keywords = KeywordIndex.build(
+            (i, sent) for i, sent in enumerate(all_sentences) if len(sent.split()) > 4
+        )
+        print(f"Keyword index has {len(self.keywords)} terms")
+        if self.compressor is not None:
+            self._add_compressed(collected_ids, collected)
         # More trees gives better accuracy
         self.index.build(trees)
+        self.clear_cache()
+
+    def _add_batch(self, sentences, ids, batch_size, pool, embedding_cache, add) -> int:
+        """Encodes the sentences with the given ids and adds them with add(id, embedding)."""
+        batch = [sentences[i] for i in ids]
+        if pool is None:
+            embeddings = self.model.encode(batch, batch_size=batch_size)
+        else:
+            embeddings = self.model.encode_multi_process(batch, pool, batch_size=batch_size)
+        for i, embedding in zip(ids, embeddings):
+            add(i, embedding)
+            if embedding_cache is not None:
+                embedding_cache.put(sentences[i], embedding)
+        return len(ids)
+
+    def _add_compressed(self, ids: List[int], embeddings: List) -> None:
+        """Fits the compressor to the collected embeddings and adds them to the index."""
+        if not ids:
+            return
+        vectors = self.compressor.prepare(np.stack(embeddings))
+        self.compressor.fit(ids, vectors, len(self.sentences))
+        for i, vector in zip(ids, self.compressor.project(vectors)):
+            self.index.add_item(i, vector)
 
     def save(self, path: str) -> None:
-        self.index.save(os.path.join(path, "index.ann"))
-        with open(os.path.join(path, "index.json"), "w", encoding="utf8") as f:
-            json.dump(self.idx_to_sentence, f)
+        self.index.save(os.path.join(path, self.index_file))
+        self.sentences.save(path)
+        if self.keywords is not None:
+            self.keywords.save(path)
+        if self.compressor is not None:
+            self.compressor.save(path)
 
     def load(self, path: str) -> None:
-        self.index.load(os.path.join(path, "index.ann"))
-        with open(os.path.join(path, "index.json"), "r", encoding="utf8") as f:
-            self.idx_to_sentence = {int(k): v for k, v in json.load(f).items()}
+        self.index.load(os.path.join(path, self.index_file))
+        self.sentences = SentenceStore.load(path)
+        self.keywords = KeywordIndex.load(path)
+        if self.compressor is not None:
+            self.compressor.load(path)
+        self.clear_cache()
 
-    def query(self, query: str, n: int = 10) -> List[str]:
-        indices = self.index.get_nns_by_vector(self.model.encode(query), n)
-        return [self.idx_to_sentence[idx] for idx in indices]
+    def _nns(self, embedding, n: int):
+        """Ids and distances of the n indexed sentences nearest to embedding."""
+        if self.compressor is None:
+            with metrics.timed("ann"):
+                return self.index.get_nns_by_vector(
+                    embedding, n, search_k=self.search_k, include_distances=True
+                )
+        query = self.compressor.prepare(embedding)
+        with metrics.timed("ann"):
+            indices, distances = self.index.get_nns_by_vector(
+                self.compressor.project(query),
+                self.compressor.candidates(n),
+                search_k=self.search_k,
+                include_distances=True,
+            )
+        if not self.compressor.quantize:
+            return indices, distances
+        with metrics.timed("rescore"):
+            return self.compressor.rescore(query, indices, n)
 
-    def query_top_chunks(
-        self, query: str, window_size: int = 10, chunks: int = 1
-    ) -> List[str]:
+    def _nns_batch(self, embeddings: List, n: int):
         """
-        Queries for top n similar sentences then gets all the sentences in the window
-        to build chunks of text to return. Useful if you want broader context for the matched
-        sentence
-        """
-        indices = self.index.get_nns_by_vector(self.model.encode(query), chunks)
-        chunks = []
-        for idx in indices:
-            start = idx - window_size
-            end = idx + window_size + 1  # Range isn't inclusive with end
-            chunks.append(
-                " ".join([self.idx_to_sentence[i] for i in range(start, end)])
+        _nns for several embeddings. Backends that can search a batch at once (ExactIndex)
+        get them all in one call.
+        """
+        if not hasattr(self.index, "get_nns_by_vectors"):
+            return [self._nns(embedding, n) for embedding in embeddings]
+        queries = np.asarray(embeddings, dtype=np.float32)
+        if self.compressor is None:
+            with metrics.timed("ann"):
+                return self.index.get_nns_by_vectors(queries, n)
+        queries = self.compressor.prepare(queries)
+        with metrics.timed("ann"):
+            found = self.index.get_nns_by_vectors(
+                self.compressor.project(queries), self.compressor.candidates(n)
             )
-        return chunks
+        if not self.compressor.quantize:
+            return found
+        with metrics.timed("rescore"):
+            return [
+                self.compressor.rescore(query, indices, n)
+                for query, (indices, _) in zip(queries, found)
+            ]
+
+    def nearest(self, embedding, n: int) -> List[SearchResult]:
+        indices, distances = self._nns(embedding, n)
+        return [
+            SearchResult(self.sentences[idx], self.source, distance, idx)
+            for idx, distance in zip(indices, distances)
+        ]
+
+    def nearest_batch(self, embeddings: List, n: int) -> List[List[SearchResult]]:
+        return [
+            [
+                SearchResult(self.sentences[idx], self.source, distance, idx)
+                for idx, distance in zip(indices, distances)
+            ]
+            for indices, distances in self._nns_batch(embeddings, n)
+        ]
+
+    def nearest_chunks(self, embedding, window_size: int, chunks: int) -> List[SearchResult]:
+        indices, distances = self._nns(embedding, chunks)
+        return self._chunk_results(indices, distances, window_size)
+
+    def nearest_chunks_batch(
+        self, embeddings: List, window_size: int, chunks: int
+    ) -> List[List[SearchResult]]:
+        return [
+            self._chunk_results(indices, distances, window_size)
+            for indices, distances in self._nns_batch(embeddings, chunks)
+        ]
+
+    def keyword_results(self, query: str, n: int) -> List[SearchResult]:
+        if self.keywords is None:
+            return []
+        with metrics.timed("keywords"):
+            indices, scores = self.keywords.search(query, n)
+        return [
+            SearchResult(self.sentences[idx], self.source, -score, idx)
+            for idx, score in zip(indices, scores)
+        ]
+
+    def chunk(self, result: SearchResult, window_size: int) -> SearchResult:
+        start = result.index - window_size
+        end = result.index + window_size + 1  # Range isn't inclusive with end
+        return result._replace(text=self.sentences.window(start, end))
+
+    def _chunk_results(self, indices, distances, window_size: int) -> List[SearchResult]:
+        results = []
+        with metrics.timed("chunks"):
+            for idx, distance in zip(indices, distances):
+                start = idx - window_size
+                end = idx + window_size + 1  # Range isn't inclusive with end
+                results.append(
+                    SearchResult(self.sentences.window(start, end), self.source, distance, idx)
+                )
+        return results
+
+
+class EmbeddingCache:
+    """
+    Every sentence embedding computed so far by one model, keyed on a hash of the sentence.
+    Stored in path as an array of embeddings plus a JSON list of the sentence hashes in row order.
+    Lets a rebuild encode only the sentences it hasn't seen before.
+    """
+
+    def __init__(self, path: str, model_name: str):
+        name = model_name.replace("/", "_")
+        self._vectors_path = os.path.join(path, f"embeddings-{name}.npy")
+        self._keys_path = os.path.join(path, f"embeddings-{name}.json")
+        self._rows = {}
+        self._vectors = []
+        if os.path.exists(self._vectors_path) and os.path.exists(self._keys_path):
+            with open(self._keys_path, "r", encoding="utf8") as f:
+                keys = json.load(f)
+            self._vectors = list(np.load(self._vectors_path))
+            self._rows = {key: row for row, key in enumerate(keys)}
+
+    def __len__(self):
+        return len(self._vectors)
+
+    @staticmethod
+    def key(sentence: str) -> str:
+        return hashlib.sha1(sentence.encode("utf8")).hexdigest()
+
+    def get(self, sentence: str):
+        row = self._rows.get(self.key(sentence))
+        return None if row is None else self._vectors[row]
+
+    def put(self, sentence: str, embedding) -> None:
+        key = self.key(sentence)
+        if key not in self._rows:
+            self._rows[key] = len(self._vectors)
+            self._vectors.append(np.asarray(embedding, dtype=np.float32))
+
+    def save(self) -> None:
+        if not self._vectors:
+            return
+        os.makedirs(os.path.dirname(self._vectors_path), exist_ok=True)
+        np.save(self._vectors_path, np.stack(self._vectors))
+        keys = sorted(self._rows, key=self._rows.get)
+        with open(self._keys_path, "w", encoding="utf8") as f:
+            json.dump(keys, f)
+
+
+def file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_tuning(path: str) -> Dict:
+    """The search parameters tune_index.py chose for the index in path, or {} if it wasn't tuned."""
+    tuning_path = os.path.join(path, TUNING_FILE)
+    if not os.path.exists(tuning_path):
+        return {}
+    with open(tuning_path, "r", encoding="utf8") as f:
+        return json.load(f)
+
+
+@contextmanager
+def index_lock(path: str):
+    """
+    Holds an exclusive lock on the index directory path, so processes starting at the same
+    time (e.g. lazy gunicorn workers) build it once and the others then load it.
+    Needs fcntl, so Unix only.
+    """
+    import fcntl
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing releases the lock
+        os.close(fd)
+
+
+def load_current_index(search: SimilaritySearch, path: str, manifest: Dict) -> bool:
+    """Loads the index in path if it was built as manifest describes. Returns whether it did."""
+    manifest_path = os.path.join(path, "manifest.json")
+    index_path = os.path.join(path, search.index_file)
+    if not os.path.exists(manifest_path) or not os.path.exists(index_path):
+        print(f"No index in {path}")
+        return False
+    with open(manifest_path, "r", encoding="utf8") as f:
+        if json.load(f) != manifest:
+            print(f"Index in {path} is out of date")
+            return False
+    print("Loading the index")
+    search.load(path)
+    return True
+
+
+def load_or_build_index(
+    search: SimilaritySearch,
+    sources: List[str],
+    path: str = "data",
+    encoder: str = DEFAULT_ENCODER,
+    quantize_encoder: bool = False,
+    trees: Optional[int] = None,
+    batch_size: int = 64,
+    processes: int = 1,
+    preprocess_processes: int = 1,
+    sentencizer: bool = False,
+    backend: Optional[str] = None,
+    search_k: Optional[int] = None,
+    clean: bool = False,
+    clean_processes: int = 1,
+    build: bool = True,
+) -> bool:
+    """
+    Loads the index in path if its manifest shows it was built from the current contents of
+    sources with the same encoder, embedding size, backend, tree count, sentence splitter and
+    compression. Otherwise rebuilds it. encoder names the search's model in encoders.ENCODERS,
+    and quantize_encoder says whether it was quantized. Rebuilds reuse the sentence splits of unchanged sources
+    and the cached embeddings of sentences seen before, so only new text is preprocessed and encoded.
+    backend, trees and search_k default to what tune_index.py recorded in path/tuning.json,
+    or to the search's backend, 10 trees and Annoy's default search_k.
+    sources can include directories, which stand for the .txt files in them. With clean,
+    sources are raw text that's cleaned as it's read (see clean_textbook.py), using
+    clean_processes worker processes.
+    Builds hold index_lock. With build False, an index that is missing or out of date is left
+    alone and nothing is written to path. Returns whether the index was loaded or built.
+    """
+    encoder_info = encoders.describe(encoder, quantize_encoder)
+    if encoder_info["dimension"] != search.embedding_size:
+        raise ValueError(
+            f"Encoder {encoder!r} makes {encoder_info['dimension']} dimensional embeddings, "
+            f"but the search expects {search.embedding_size}"
+        )
+    sources = expand_sources(sources)
+    tuning = read_tuning(path)
+    backend = backend or tuning.get("backend", search.backend)
+    if backend != search.backend:
+        search.use_backend(backend)
+    trees = trees if trees is not None else tuning.get("trees", 10)
+    search.search_k = search_k if search_k is not None else tuning.get("search_k", -1)
+    manifest = {
+        "version": INDEX_FORMAT_VERSION,
+        "sources": [{"path": source, "sha256": file_hash(source)} for source in sources],
+        "encoder": encoder_info,
+        "embedding_size": search.embedding_size,
+        "backend": backend,
+        "trees": trees,
+        "splitter": "sentencizer" if sentencizer else "parser",
+        "cleaned": clean,
+        "compression": search.compressor.config() if search.compressor is not None else None,
+    }
+    if not build:
+        return load_current_index(search, path, manifest)
+    os.makedirs(path, exist_ok=True)
+    with index_lock(path):
+        # Another process may have built it while this one waited for the lock
+        if load_current_index(search, path, manifest):
+            return True
+
+        cache_path = os.path.join(path, "cache")
+        os.makedirs(cache_path, exist_ok=True)
+
+        def iter_sentences() -> Iterator[str]:
+            """Streams the sentences of every source, splitting only the ones not in the cache."""
+            preprocessor = None
+            for source in manifest["sources"]:
+                name = f"sentences-{source['sha256']}-{manifest['splitter']}"
+                if clean:
+                    name += "-cleaned"
+                sentences_path = os.path.join(cache_path, name + ".json")
+                if os.path.exists(sentences_path):
+                    with open(sentences_path, "r", encoding="utf8") as f:
+                        yield from json.load(f)
+                    continue
+                print(f"Preprocessing {source['path']}...")
+                if preprocessor is None:
+                    preprocessor = Preprocessor(preprocess_processes, sentencizer=sentencizer)
+                cleaner = Cleaner(clean_processes) if clean else None
+                source_sentences = []
+                for sent in preprocessor.iter_sentences(source["path"], cleaner):
+                    source_sentences.append(sent)
+                    yield sent
+                if cleaner is not None:
+                    print(f"Cleaned {source['path']}: {json.dumps(cleaner.stats())}")
+                with open(sentences_path, "w", encoding="utf8") as f:
+                    json.dump(source_sentences, f)
+
+        embedding_cache = EmbeddingCache(cache_path, encoders.cache_name(encoder, quantize_encoder))
+        search.build_annoy_index(
+            iter_sentences(),
+            trees=trees,
+            batch_size=batch_size,
+            processes=processes,
+            embedding_cache=embedding_cache,
+        )
+        embedding_cache.save()
+        search.save(path)
+        with open(os.path.join(path, "manifest.json"), "w", encoding="utf8") as f:
+            json.dump(manifest, f, indent=2)
+    return True
+
+
+class ShardedSearch(CachedQueries):
+    """
+    Searches several sources, each with its own index shard (an Annoy index, keyword index
+    and sentence store) so they can be built and reloaded independently. Queries are encoded once, sent to
+    every shard concurrently, and the results merged by distance. Chunk windows come from a
+    single shard so they never run across two sources.
+    Every shard is built with the same compression settings, each fitting its own PCA. Distances
+    in different projections can't be merged, so PCA without quantize only works with one shard.
+    """
+
+    def __init__(
+        self,
+        model,
+        embedding_size=768,
+        cache_size=1024,
+        max_workers: int = 8,
+        compression: Optional[Dict] = None,
+    ):
+        self.model = model
+        self.embedding_size = embedding_size
+        self.cache_size = cache_size
+        self.compression = compression
+        self.encoder = QueryEncoder(model, cache_size)
+        self.result_cache = LRUCache(cache_size, "query_results")
+        self.shards: Dict[str, SimilaritySearch] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def load_or_build_shard(
+        self, name: str, sources: List[str], path: str, title: Optional[str] = None, **kwargs
+    ) -> SimilaritySearch:
+        """
+        Loads the shard called name from path, building it from sources first if needed,
+        and swaps it in for any shard of the same name. Results are labelled with title.
+        kwargs are passed on to load_or_build_index. Returns None, leaving the shards as they
+        were, if build=False is passed and the shard in path is missing or out of date.
+        """
+        shard = SimilaritySearch(
+            self.model,
+            self.embedding_size,
+            self.cache_size,
+            title or name,
+            self.encoder,
+            self.compression,
+        )
+        self._check_comparable(name, shard)
+        if not load_or_build_index(shard, sources, path, **kwargs):
+            return None
+        self.add_shard(name, shard)
+        return shard
+
+    def _check_comparable(self, name: str, shard: SimilaritySearch) -> None:
+        """Raises ValueError if shard's distances can't be merged with the other shards'."""
+        if self.shards.keys() - {name} and shard.compressor is not None:
+            if not shard.compressor.comparable:
+                raise ValueError(
+                    "Shards compressed with PCA but not quantize can't be searched together, "
+                    "since each fits its own projection. Set quantize to re-score with the "
+                    "full embeddings."
+                )
+
+    def add_shard(self, name: str, shard: SimilaritySearch) -> None:
+        self._check_comparable(name, shard)
+        self.shards = {**self.shards, name: shard}
+        self.clear_cache()
+
+    def remove_shard(self, name: str) -> None:
+        self.shards = {k: v for k, v in self.shards.items() if k != name}
+        self.clear_cache()
+
+    def chunk(self, result: SearchResult, window_size: int) -> SearchResult:
+        """Widens result using the shard it came from, found by its source."""
+        for shard in self.shards.values():
+            if shard.source == result.source:
+                return shard.chunk(result, window_size)
+        raise KeyError(f"No shard for source {result.source!r}")
+
+    def _fan_out(self, search, n: int) -> List[SearchResult]:
+        """Runs search on every shard at once and keeps the n closest results."""
+        shards = list(self.shards.values())
+        results = self._executor.map(metrics.propagate(search), shards)
+        return heapq.nsmallest(
+            n, (r for shard_results in results for r in shard_results), key=lambda r: r.distance
+        )
+
+    def nearest(self, embedding, n: int) -> List[SearchResult]:
+        return self._fan_out(lambda shard: shard.nearest(embedding, n), n)
+
+    def keyword_results(self, query: str, n: int) -> List[SearchResult]:
+        """
+        Each shard's best matches, merged by rank with reciprocal rank fusion. BM25 scores
+        depend on each shard's own term statistics, so they can't be compared across shards.
+        """
+
+        def search(shard):
+            return shard.keyword_results(query, n)
+
+        shards = list(self.shards.values())
+        return fuse_results(*self._executor.map(metrics.propagate(search), shards), n=n)
+
+    def nearest_chunks(self, embedding, window_size: int, chunks: int) -> List[SearchResult]:
+        return self._fan_out(
+            lambda shard: shard.nearest_chunks(embedding, window_size, chunks), chunks
+        )
+
+    def _fan_out_batch(self, search, embeddings: List, n: int) -> List[List[SearchResult]]:
+        """Runs search for the whole batch on every shard at once, then merges per embedding."""
+        merged = [[] for _ in embeddings]
+        for shard_results in self._executor.map(metrics.propagate(search), list(self.shards.values())):
+            for i, results in enumerate(shard_results):
+                merged[i].extend(results)
+        return [heapq.nsmallest(n, results, key=lambda r: r.distance) for results in merged]
+
+    def nearest_batch(self, embeddings: List, n: int) -> List[List[SearchResult]]:
+        return self._fan_out_batch(lambda shard: shard.nearest_batch(embeddings, n), embeddings, n)
+
+    def nearest_chunks_batch(
+        self, embeddings: List, window_size: int, chunks: int
+    ) -> List[List[SearchResult]]:
+        return self._fan_out_batch(
+            lambda shard: shard.nearest_chunks_batch(embeddings, window_size, chunks),
+            embeddings,
+            chunks,
+        )
 
 
 class Preprocessor:
-    def __init__(self):
-        self.nlp = spacy.load("en_core_web_sm")
+    """
+    Splits reference text into sentences. The text is read and parsed a paragraph at a time
+    with nlp.pipe, so memory stays flat and spaCy's max_length is never hit, however big
+    the file. n_process > 1 parses paragraphs in several worker processes.
+    """
+
+    def __init__(self, n_process: int = 1, batch_size: int = 64, sentencizer: bool = False):
+        self.n_process = n_process
+        self.batch_size = batch_size
+        if sentencizer:
+            # Rule based sentence splitting, much faster than the parser but less accurate
+            self.nlp = spacy.blank("en")
+            self.nlp.add_pipe(self.nlp.create_pipe("sentencizer"))
+        else:
+            # The parser is all that's needed to split sentences
+            self.nlp = spacy.load("en_core_web_sm", disable=["tagger", "ner", "lemmatizer"])
+
+    @staticmethod
+    def iter_paragraphs(
+        path: str, max_chars: int = 10000, cleaner: Optional[Cleaner] = None
+    ) -> Iterator[str]:
+        """
+        Yields blank line separated paragraphs of the file, cut at line boundaries into
+        pieces of about max_chars. With a cleaner, only the lines it keeps are read.
+        """
+        if cleaner is not None:
+            yield from Preprocessor.split_paragraphs(cleaner.iter_clean([path]), max_chars)
+            return
+        with open(path, "r", encoding="utf8") as f:
+            yield from Preprocessor.split_paragraphs(f, max_chars)
+
+    @staticmethod
+    def split_paragraphs(lines: Iterable[str], max_chars: int = 10000) -> Iterator[str]:
+        lines_so_far = []
+        size = 0
+        for line in lines:
+            if line.strip():
+                lines_so_far.append(line)
+                size += len(line)
+            if lines_so_far and (not line.strip() or size >= max_chars):
+                yield "".join(lines_so_far)
+                lines_so_far = []
+                size = 0
+        if lines_so_far:
+            yield "".join(lines_so_far)
+
+    def iter_sentences(self, path: str, cleaner: Optional[Cleaner] = None) -> Iterator[str]:
+        """
+        Preprocesses a raw text file to use as context for question answering,
+        yielding sentences as they are split. With a cleaner (see clean_textbook.py), the
+        file is cleaned on the way in.
+        """
+        docs = self.nlp.pipe(
+            self.iter_paragraphs(path, cleaner=cleaner),
+            n_process=self.n_process,
+            batch_size=self.batch_size,
+        )
+        for doc in docs:
+            for sent in doc.sents:
+                if sent.text.strip():
+                    yield sent.text
 
     def preprocess_text(self, path: str) -> List[str]:
         """
         Preprocesses a raw text file to use as context for question answering.
         """
-        with open(path, "r", encoding="utf8") as f:
-            doc = self.nlp(f.read())
-        # Throw out short sentence junk
-        return [sent.text for sent in doc.sents]
+        return list(self.iter_sentences(path))
 
 
 def main():
     parser = ArgumentParser()
     parser.add_argument(
-        "text", help="A single text file to be used as the reference material"
+        "text", help="A text file, or a directory of .txt files, to be used as the reference material"
     )
     parser.add_argument("question", help="The question that you want answered")
     parser.add_argument(
@@ -105,22 +1235,90 @@ def main():
     )
     parser.add_argument("--n", type=int, default=3, help="Number of chunks to use")
     parser.add_argument("--window-size", type=int, default=25)
+    parser.add_argument(
+        "--index-path", default="data", help="Directory to keep the index for the text in"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=64, help="Sentences per encode call when building"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="CPU worker processes to encode with when building the index",
+    )
+    parser.add_argument(
+        "--preprocess-processes",
+        type=int,
+        default=1,
+        help="Worker processes to split sentences with when building the index",
+    )
+    parser.add_argument(
+        "--sentencizer",
+        action="store_true",
+        default=False,
+        help="Split sentences with spaCy's rule based sentencizer instead of the parser",
+    )
+    parser.add_argument(
+        "--clean",
+        action="store_true",
+        default=False,
+        help="Clean the raw text on the way into the index, see clean_textbook.py",
+    )
+    parser.add_argument(
+        "--clean-processes", type=int, default=1, help="Worker processes to clean with"
+    )
+    parser.add_argument(
+        "--normalize",
+        action="store_true",
+        default=False,
+        help="L2 normalize embeddings and use an angular index",
+    )
+    parser.add_argument(
+        "--pca-dim", type=int, help="Reduce embeddings to this many dimensions with PCA"
+    )
+    parser.add_argument(
+        "--quantize",
+        choices=["float16", "int8"],
+        help="Re-score index candidates against embeddings stored with this precision",
+    )
+    parser.add_argument(
+        "--encoder",
+        choices=list(encoders.ENCODERS),
+        default=DEFAULT_ENCODER,
+        help="Sentence encoder to embed with, see encoders.py",
+    )
+    parser.add_argument(
+        "--quantize-encoder",
+        action="store_true",
+        default=False,
+        help="Quantize the encoder to int8 for faster CPU inference",
+    )
     args = parser.parse_args()
 
-    model = SentenceTransformer("bert-base-nli-mean-tokens")
-    size = 768  # Sentence embedding size
-    search = SimilaritySearch(model, size)
-
-    if not os.path.exists("data/index.ann"):
-        print("Index doesn't exist. Creating an index...")
-        print("Preprocessing...")
-        preprocessor = Preprocessor()
-        sentences = preprocessor.preprocess_text(args.text)
-        search.build_annoy_index(sentences)
-        search.save("data")
-    else:
-        print("Loading the index")
-        search.load("data")
+    model = encoders.load_encoder(args.encoder, args.quantize_encoder)
+    size = encoders.get_encoder(args.encoder).dimension
+    compression = None
+    if args.normalize or args.pca_dim or args.quantize:
+        compression = {
+            "normalize": args.normalize,
+            "pca_dim": args.pca_dim,
+            "quantize": args.quantize,
+        }
+    search = SimilaritySearch(model, size, compression=compression)
+    load_or_build_index(
+        search,
+        [args.text],
+        args.index_path,
+        encoder=args.encoder,
+        quantize_encoder=args.quantize_encoder,
+        batch_size=args.batch_size,
+        processes=args.processes,
+        preprocess_processes=args.preprocess_processes,
+        sentencizer=args.sentencizer,
+        clean=args.clean,
+        clean_processes=args.clean_processes,
+    )
 
     if args.best:
         result = search.query(args.question, n=1)
@@ -1,4 +1,4 @@
-import React, { useReducer } from 'react';
+import React, { useReducer, useRef } from 'react';
 import chatReducer from './chatReducer';
 import { ADD_MESSAGE, CLEAR_MESSAGES } from '../types';
 import ChatContext from './chatContext';
@@ -15,6 +15,10 @@ const ChatState = (props) => {
   };
 
   const [state, dispatch] = useReducer(chatReducer, initialState);
+  // Identifies this conversation to the server, which keeps dialogue state per session
+  const sessionId = useRef(
+    Math.random().toString(36).slice(2) + Date.now().toString(36)
+  );
 
   const respondTo = async (message) => {
     const { text } = message;
@@ -22,6 +26,7 @@ const ChatState = (props) => {
     try {
       const res = await axios.post('http://localhost:5000/ask', {
         question: text,
+        session_id: sessionId.current,
       });
 
       dispatch({
@@ -10,6 +10,8 @@ Port argument are optional and defaults to 5000.
 """
 
 import argparse
+import uuid
+
 import requests
 
 HEADERS = {"Content-Type": "application/json"}
@@ -18,6 +20,7 @@ PROMPT = "> "
 
 def repl(port):
     print("Type a message and press enter to send to ATAM. Send `exit` to quit.")
+    session_id = uuid.uuid4().hex
     try:
         text = input(PROMPT)
     except:
@@ -26,6 +29,7 @@ def repl(port):
     while text.lower() != "exit":
         data = {
             "question": text,
+            "session_id": session_id,
         }
 
         response = requests.post(
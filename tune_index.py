@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+"""
+Picks search parameters for a built index.
+
+python tune_index.py data/shards/jurafsky_and_martin --k 10 --target-recall 0.95
+
+Builds Annoy indexes over the index's cached embeddings with a range of tree counts, and for
+each measures recall@k and latency over a range of search_k values. Recall is measured against
+exact search (backends.ExactIndex) on the questions in data/benchmark_questions.txt.
+The fastest setting that reaches the target recall is picked, or the exact backend if that is
+faster still. The choice is written to tuning.json in the index directory, where
+load_or_build_index picks it up, rebuilding the index if the tree count changed.
+"""
+import json
+import os
+import time
+from argparse import ArgumentParser
+from typing import Dict, List
+
+import numpy as np
+from annoy import AnnoyIndex
+
+import encoders
+from backends import ExactIndex
+from benchmark import QUESTIONS_PATH, load_questions
+from questionanswer import TUNING_FILE, EmbeddingCache, SimilaritySearch
+
+
+def load_vectors(search: SimilaritySearch, embedding_cache: EmbeddingCache):
+    """
+    The ids and index vectors of the sentences in the index, compressed the way the index
+    compresses them. Embeddings missing from the cache are encoded.
+    """
+    ids, embeddings, missing = [], [], []
+    for i in range(len(search.sentences)):
+        sentence = search.sentences[i]
+        if len(sentence.split()) <= 4:
+            continue
+        ids.append(i)
+        embeddings.append(embedding_cache.get(sentence))
+        if embeddings[-1] is None:
+            missing.append(len(embeddings) - 1)
+    if missing:
+        print(f"Encoding {len(missing)} sentences missing from the embedding cache")
+        encoded = search.model.encode([search.sentences[ids[row]] for row in missing])
+        for row, embedding in zip(missing, encoded):
+            embeddings[row] = embedding
+    return ids, to_index_space(search, np.stack(embeddings))
+
+
+def to_index_space(search: SimilaritySearch, vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if search.compressor is None:
+        return vectors
+    return search.compressor.project(search.compressor.prepare(vectors))
+
+
+def mean_latency_ms(index, queries, n: int, search_k: int, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            index.get_nns_by_vector(query, n, search_k=search_k)
+    return (time.perf_counter() - start) / (repeat * len(queries)) * 1000
+
+
+def recall(truth: List[List[int]], found: List[List[int]]) -> float:
+    return float(np.mean([len(set(t) & set(f)) / len(t) for t, f in zip(truth, found)]))
+
+
+def tune(
+    search: SimilaritySearch,
+    ids: List[int],
+    vectors,
+    queries,
+    k: int = 10,
+    target_recall: float = 0.95,
+    trees_options=(5, 10, 25, 50, 100),
+    search_k_factors=(1, 2, 5, 10, 20, 50),
+    repeat: int = 3,
+) -> Dict:
+    """
+    Sweeps trees and search_k (search_k_factors times trees * n, where factor 1 is
+    Annoy's default) and returns the chosen parameters with the measurements behind them.
+    """
+    metric = search.compressor.metric if search.compressor is not None else "euclidean"
+    # With quantized re-scoring, the index is asked for more candidates than results
+    n = search.compressor.candidates(k) if search.compressor is not None else k
+    exact = ExactIndex(vectors.shape[1], metric)
+    for i, vector in zip(ids, vectors):
+        exact.add_item(i, vector)
+    exact.build()
+    truth = [indices for indices, _ in exact.get_nns_by_vectors(queries, n)]
+    exact_latency = mean_latency_ms(exact, queries, n, -1, repeat)
+    print(f"exact: {exact_latency:.3f}ms")
+
+    sweep = []
+    for trees in trees_options:
+        annoy = AnnoyIndex(vectors.shape[1], metric)
+        for i, vector in zip(ids, vectors):
+            annoy.add_item(i, vector)
+        annoy.build(trees)
+        for factor in search_k_factors:
+            search_k = factor * trees * n
+            found = [annoy.get_nns_by_vector(query, n, search_k=search_k) for query in queries]
+            result = {
+                "trees": trees,
+                "search_k": search_k,
+                "recall": recall(truth, found),
+                "latency_ms": mean_latency_ms(annoy, queries, n, search_k, repeat),
+            }
+            print(
+                f"trees={trees} search_k={search_k}: recall@{k} {result['recall']:.3f}, "
+                f"{result['latency_ms']:.3f}ms"
+            )
+            sweep.append(result)
+
+    good = [result for result in sweep if result["recall"] >= target_recall]
+    best = min(good, key=lambda result: result["latency_ms"]) if good else None
+    if best is None or exact_latency <= best["latency_ms"]:
+        chosen = {"backend": "exact", "recall": 1.0, "latency_ms": exact_latency}
+    else:
+        chosen = {"backend": "annoy", **best}
+    return {
+        **chosen,
+        "k": k,
+        "target_recall": target_recall,
+        "exact_latency_ms": exact_latency,
+        "queries": len(queries),
+        "sweep": sweep,
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("path", help="Index directory, e.g. data/shards/jurafsky_and_martin")
+    parser.add_argument("--questions", default=QUESTIONS_PATH, help="One question per line")
+    parser.add_argument("--k", type=int, default=10, help="Number of results to measure recall on")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--trees", type=int, nargs="+", default=[5, 10, 25, 50, 100])
+    parser.add_argument(
+        "--search-k-factors",
+        type=int,
+        nargs="+",
+        default=[1, 2, 5, 10, 20, 50],
+        help="search_k values to try, as multiples of trees * k",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Times to time each question")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.path, "manifest.json"), "r", encoding="utf8") as f:
+        manifest = json.load(f)
+    encoder = manifest["encoder"]
+    model = encoders.load_encoder(encoder["name"], encoder["quantized"])
+    search = SimilaritySearch(
+        model,
+        manifest["embedding_size"],
+        compression=manifest.get("compression"),
+        backend=manifest.get("backend", "annoy"),
+    )
+    search.load(args.path)
+    embedding_cache = EmbeddingCache(
+        os.path.join(args.path, "cache"), encoders.cache_name(encoder["name"], encoder["quantized"])
+    )
+    ids, vectors = load_vectors(search, embedding_cache)
+    queries = to_index_space(search, model.encode(load_questions(args.questions)))
+
+    tuning = tune(
+        search,
+        ids,
+        vectors,
+        queries,
+        args.k,
+        args.target_recall,
+        args.trees,
+        args.search_k_factors,
+        args.repeat,
+    )
+    with open(os.path.join(args.path, TUNING_FILE), "w", encoding="utf8") as f:
+        json.dump(tuning, f, indent=2)
+    if tuning["backend"] == "exact":
+        print(f"Picked exact search ({tuning['latency_ms']:.3f}ms)")
+    else:
+        print(
+            f"Picked trees={tuning['trees']} search_k={tuning['search_k']} "
+            f"(recall@{args.k} {tuning['recall']:.3f}, {tuning['latency_ms']:.3f}ms)"
+        )
+
+
+if __name__ == "__main__":
+    main()
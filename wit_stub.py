@@ -0,0 +1,115 @@
+"""
+Local stand-in for Wit.ai, for benchmarks and load tests. Classifies messages with a few
+keyword rules into the same response shape as Wit.ai, after waiting latency seconds to
+mimic the network round trip.
+
+StubWitBackend can be passed straight to create_app. To stand in for Wit.ai in a separately
+running server, serve it over HTTP and point the wit client at it with WIT_URL:
+
+python wit_stub.py --port 8001 --latency 0.05
+WIT_URL=http://localhost:8001 python qa_web_app.py
+"""
+import json
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import parse_qs, urlparse
+
+from intents import LocalIntentClassifier, SEARCH_QUERY_ENTITY
+from questionanswer import normalize_query
+
+EXIT_WORDS = {"exit", "bye", "goodbye", "quit"}
+YES_WORDS = {"yes", "yeah", "yep", "sure", "ok", "okay"}
+NO_WORDS = {"no", "nope", "nah"}
+GREETING_WORDS = {"hi", "hello", "hey", "howdy"}
+GRADES_WORDS = {"grade", "grades", "graded"}
+ASSIGNMENT_WORDS = {"homework", "assignment", "assignments", "pset"}
+MULTI_WORDS = {"questions"}
+
+
+def classify(text: str) -> str:
+    """Picks an intent for text with keyword rules, defaulting to question."""
+    words = normalize_query(text).split()
+    if not words:
+        return "fallback"
+    first = words[0]
+    if set(words) & EXIT_WORDS:
+        return "exit"
+    if first in YES_WORDS:
+        return "yes"
+    if first in NO_WORDS:
+        return "no"
+    if first in GREETING_WORDS and len(words) <= 3:
+        return "greeting"
+    if set(words) & GRADES_WORDS:
+        return "grades"
+    if set(words) & ASSIGNMENT_WORDS:
+        return "assignment"
+    if set(words) & MULTI_WORDS:
+        return "multi_question"
+    return "question"
+
+
+class StubWitBackend:
+    """Intent backend that answers like Wit.ai without leaving the process."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def message(self, text: str) -> Dict:
+        if self.latency:
+            time.sleep(self.latency)
+        intent = classify(text)
+        response = {
+            "text": text,
+            "intents": [{"id": intent, "name": intent, "confidence": 1.0}],
+            "entities": {},
+        }
+        if intent == "question":
+            response["entities"][SEARCH_QUERY_ENTITY] = LocalIntentClassifier.search_query_entities(text)
+        return response
+
+
+class StubWitHandler(BaseHTTPRequestHandler):
+    """Answers GET /message?q=... like Wit.ai's message API. The access token isn't checked."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/message":
+            self.send_error(404)
+            return
+        text = parse_qs(url.query).get("q", [""])[0]
+        body = json.dumps(self.server.backend.message(text)).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # One line per request would swamp the output of a load test
+        pass
+
+
+def serve(port: int = 8001, latency: float = 0.0) -> None:
+    server = ThreadingHTTPServer(("", port), StubWitHandler)
+    server.daemon_threads = True
+    server.backend = StubWitBackend(latency)
+    print(f"Wit.ai stub listening on http://localhost:{port} with {latency}s latency")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds to wait before answering each call"
+    )
+    args = parser.parse_args()
+    serve(args.port, args.latency)